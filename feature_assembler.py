@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class FeatureAssembler:
+    """
+    Meta data of applicants assembled into one preallocated float32 matrix: the columns of the applications
+    followed by the columns of each summary table, joined by applicant id as chained DataFrame joins would.
+
+    The summary blocks and their column names are laid out once, so assembling allocates the output once
+    and copies each block into its column range at the rows of the applicants found in it. Missing values
+    and applicants without summary rows are zeros.
+    """
+    def __init__(self, summaries):
+        """
+        :param summaries: list of (summary table indexed by id, suffix of its column names already taken by
+        the applications or an earlier summary), in join order
+        """
+        self._summaries = []
+        for summary, suffix in summaries:
+            ids = summary.index.values
+            order = None if np.all(ids[1:] > ids[:-1]) else np.argsort(ids, kind='stable')
+            self._summaries.append((summary, suffix, ids if order is None else ids[order], order))
+
+    def columns(self, application_columns):
+        """
+        Names of the application columns and the columns of every summary, a name already taken getting
+        the suffix of its summary
+        """
+        names = list(application_columns)
+        taken = set(names)
+        for summary, suffix, _, _ in self._summaries:
+            block = [col + suffix if col in taken else col for col in summary.columns]
+            taken.update(block)
+            names += block
+        return names
+
+    def assemble(self, applications, columns, na_applications=False):
+        """
+        :param applications: DataFrame of numeric application columns indexed by id
+        :param columns: names of the output columns, e.g. the layout a scaler was fit on, names not in any
+        block are zeros
+        :param na_applications: keep the na values of the application columns, e.g. to take statistics of
+        applications before they are imputed
+        :return: float32 array with a row per application and a column per name
+        """
+        out = np.zeros((len(applications), len(columns)), dtype=np.float32)
+        positions = {name: i for i, name in enumerate(columns)}
+
+        # the applications block
+        names = [col for col in applications.columns if col in positions]
+        self._copy_block(out, [positions[col] for col in names], slice(None), applications[names].to_numpy(np.float32),
+                         fill_na=not na_applications)
+
+        # each summary block at the rows of the applicants it has
+        taken = set(applications.columns)
+        ids = applications.index.values
+        for summary, suffix, summary_ids, order in self._summaries:
+            block = [col + suffix if col in taken else col for col in summary.columns]
+            taken.update(block)
+            sources = [j for j, name in enumerate(block) if name in positions]
+            if not sources:
+                continue
+
+            rows = np.searchsorted(summary_ids, ids)
+            rows[rows == len(summary_ids)] = 0
+            found = np.flatnonzero(summary_ids[rows] == ids) if len(summary_ids) else np.empty(0, dtype=np.int64)
+            summary_rows = rows[found] if order is None else order[rows[found]]
+            values = summary.iloc[summary_rows, sources].to_numpy(np.float32)
+            self._copy_block(out, [positions[block[j]] for j in sources], found, values)
+
+        return out
+
+    @staticmethod
+    def _copy_block(out, targets, rows, values, fill_na=True):
+        if fill_na:
+            values[np.isnan(values)] = 0
+        if isinstance(rows, slice):
+            out[:, targets] = values
+        else:
+            out[np.ix_(rows, targets)] = values
@@ -0,0 +1,95 @@
+import os
+import hashlib
+import logging
+import numpy as np
+from tensor_store import TensorStore, read_rows
+
+
+class FeatureBinner:
+    """
+    Map each feature to uint8 bin codes using quantile bins fit on training data. Features with few
+    distinct values get one bin per value and na values get their own code, max_bins.
+
+    Tree models split the codes at the same places as the raw features up to the bin resolution, so a
+    binned matrix can be shared by all tree learners at a fraction of the memory of float features.
+    """
+    def __init__(self, max_bins=255, subsample=200000, random_state=0):
+        """
+        :param max_bins: number of bins for non-na values, at most 255
+        :param subsample: number of rows used to find the bin edges
+        """
+        if not 2 <= max_bins <= 255:
+            raise ValueError('max_bins must be between 2 and 255, got {}'.format(max_bins))
+        self._max_bins = max_bins
+        self._subsample = subsample
+        self._random_state = random_state
+        self._edges = None
+
+    def fit(self, data):
+        rs = np.random.RandomState(self._random_state)
+        rows = np.arange(data.shape[0])
+        if len(rows) > self._subsample:
+            rows = np.sort(rs.choice(rows, self._subsample, replace=False))
+        sample = read_rows(data, rows).astype(np.float64)
+
+        self._edges = []
+        for j in range(sample.shape[1]):
+            values = sample[:, j][~np.isnan(sample[:, j])]
+            distinct = np.unique(values)
+            if len(distinct) <= self._max_bins:
+                # one bin per distinct value, split halfway between neighbours
+                edges = (distinct[:-1] + distinct[1:]) / 2
+            else:
+                edges = np.unique(np.percentile(values, np.linspace(0, 100, self._max_bins + 1)[1:-1]))
+            self._edges.append(edges)
+        return self
+
+    def transform(self, data, chunk_rows=65536):
+        codes = np.empty(data.shape, dtype=np.uint8)
+        for start in range(0, data.shape[0], chunk_rows):
+            rows = np.arange(start, min(start + chunk_rows, data.shape[0]))
+            values = read_rows(data, rows)
+            for j, edges in enumerate(self._edges):
+                column_codes = np.searchsorted(edges, values[:, j], side='right')
+                column_codes[np.isnan(values[:, j])] = self._max_bins
+                codes[start:start + len(rows), j] = column_codes
+        return codes
+
+    def fit_transform(self, data):
+        return self.fit(data).transform(data)
+
+
+def binned_features(data_train, data_val, max_bins=255, cache_dir=os.path.join('data', 'cache', 'binned')):
+    """
+    Bin train and validation features with bins fit on the train features.
+
+    Results are cached memory-mapped in cache_dir by the content of both matrices, so every experiment
+    and every tree model trained on the same fold reuses one binned copy instead of binning again.
+
+    :param data_train: 2d train features
+    :param data_val: 2d validation features binned with the train bins
+    :param cache_dir: directory of the on-disk cache, None to bin without caching
+    :return: tuple of uint8 (binned train, binned validation)
+    """
+    key = hashlib.blake2b(digest_size=8)
+    key.update(str(max_bins).encode())
+    for data in (data_train, data_val):
+        key.update(str(data.shape).encode())
+        for start in range(0, data.shape[0], 65536):
+            rows = np.arange(start, min(start + 65536, data.shape[0]))
+            key.update(np.ascontiguousarray(read_rows(data, rows), dtype=np.float32).tobytes())
+    key = key.hexdigest()
+
+    store = TensorStore(cache_dir) if cache_dir is not None else None
+    if store is not None and 'train_{}'.format(key) in store and 'val_{}'.format(key) in store:
+        logging.debug('Loading binned features {} from {}'.format(key, cache_dir))
+        binned = store.load('train_{}'.format(key)), store.load('val_{}'.format(key))
+    else:
+        logging.debug('Binning features into {} bins'.format(max_bins))
+        binner = FeatureBinner(max_bins=max_bins).fit(data_train)
+        binned = binner.transform(data_train), binner.transform(data_val)
+        if store is not None:
+            binned = (store.save('train_{}'.format(key), binned[0], dtype=np.uint8),
+                      store.save('val_{}'.format(key), binned[1], dtype=np.uint8))
+
+    return binned
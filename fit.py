@@ -1,90 +1,57 @@
+import os
 import logging
 from datetime import datetime
 import numpy as np
 import pandas as pd
-from prepare_data import HCDRDataLoader
-from scipy.stats import logistic
-from sklearn.linear_model import LogisticRegression
-from imblearn.over_sampling import RandomOverSampler
+from prepare_data import HCDRDataLoader, HCDRInferenceLoader
 from sklearn.model_selection import KFold
-from models import DenseNN, GBC, ABC, DTC, MultiLSTMWithMetadata
+from models import DenseNN, GBC, ABC, DTC, HGB, MultiLSTMWithMetadata, EpochTimer, available_sequence_encoders
 from grid_search import grid_search
+from search_strategies import SuccessiveHalving
+from stacking import BaseModel, OOFCache, Stacker, Ensemble
+from table_store import get_table_store
 from sklearn.svm import LinearSVC
-from sklearn.metrics import confusion_matrix
-
-
-def ensemble_fit_predict():
-    loader_args = {
-        'cc_tmax': 60,
-        'bureau_tmax': 60,
-        'pos_tmax': 60
-    }
-
-    loader = HCDRDataLoader(**loader_args)
-
-    # load training and test data
-    data_train, target_train = loader.load_train_data()
-    data_val = loader.load_test_data()
-
-    # oversample troubled loans to make up for imbalance
-    ros = RandomOverSampler()
-    os_index, target_train_os = ros.fit_sample(np.arange(data_train[0].shape[0]).reshape(-1, 1), target_train)
-    data_train_os = [data_train_part[os_index.squeeze()] for data_train_part in data_train]
-
-    # use predict on out of sample data and store results for each model
-    num_models = 4
-    train_samples = data_train[0].shape[0]
-    test_samples = data_val[0].shape[0]
-    train_results = np.empty((train_samples, num_models))
-    val_results = np.empty((test_samples, num_models))
-
-    # dense neural network
-    logging.debug('Training dense neural network')
-    model_args = {
-        'hidden_dim': 64,
-        'num_layers': 1,
-        'l2_reg': 5e-5,
-        'epochs': 20,
-        'batch_size': 1024,
-        'dropout': 0.4
-    }
-
-    dense_nn = DenseNN(data_train_os[0].shape[1], **model_args)
-    dense_nn.fit(data_train_os[0], target_train_os)
-
-    train_results[:, 0] = dense_nn.predict(data_train[0]).squeeze()
-    val_results[:, 0] = dense_nn.predict(data_val[0]).squeeze()
-
-    # gradient boosting classifier
-    logging.debug('Training gradient boosting classifier')
-    gbc = GBC(
-        max_depth=5,
-        n_estimators=30,
-        min_samples_split=0.01,
-        learning_rate=0.3
-    )
-    gbc.fit(data_train_os[0], target_train_os)
-
-    train_results[:, 1] = gbc.predict(data_train[0]).squeeze()
-    val_results[:, 1] = gbc.predict(data_val[0]).squeeze()
-
-    # adaboost classifier
-    logging.debug('Training adaboost classifier')
-    abc = ABC(
-        n_estimators=20,
-        learning_rate=1.0
-    )
-    abc.fit(data_train_os[0], target_train_os)
-
-    train_results[:, 2] = abc.predict(data_train[0]).squeeze()
-    val_results[:, 2] = abc.predict(data_val[0]).squeeze()
-
-    # multi lstm network with metadata
-    logging.debug('Training multi lstm nn')
-    model_args = {
+from sklearn.metrics import confusion_matrix, roc_auc_score
+
+
+def boosting_base_model(hist_boosting=False):
+    """
+    Gradient boosting base model of the ensemble, histogram boosting on the binned meta data with the
+    same depth, rounds and learning rate when hist_boosting is set
+    """
+    if hist_boosting:
+        return BaseModel('gbc', HGB, {
+            'max_depth': 5,
+            'n_estimators': 30,
+            'learning_rate': 0.3
+        }, binned=True, memory_mb=1024)
+    return BaseModel('gbc', GBC, {
+        'max_depth': 5,
+        'n_estimators': 30,
+        'min_samples_split': 0.01,
+        'learning_rate': 0.3
+    }, memory_mb=2048)
+
+
+ENSEMBLE_LOADER_ARGS = {
+    'cc_tmax': 60,
+    'bureau_tmax': 60,
+    'pos_tmax': 60,
+    'install_mos_max': 60
+}
+
+
+def ensemble_base_models(hist_boosting=False):
+    """
+    Base models of the stacked ensemble, the tree models share one binned copy of the meta data with
+    histogram boosting. Thread and memory hints are for concurrent training on the full data set, the
+    sklearn models use one core and the keras models share the rest.
+    """
+    keras_threads = max(1, ((os.cpu_count() or 1) - 2) // 2)
+    lstm_args = {
         'epochs': 35,
         'batch_size': 8192,
-        'lstm_gpu': True,
+        'sequence_encoder': 'auto',
         'sequence_dense_layers': 0,
         'sequence_dense_width': 8,
         'sequence_l2_reg': 0,
@@ -100,177 +67,149 @@ def ensemble_fit_predict():
         'lstm_l2_reg': 1e-5
     }
 
-    input_shape = loader.get_input_shape()
-    lstm_nn = MultiLSTMWithMetadata(input_shape, **model_args)
-    lstm_nn.fit(data_train_os, target_train_os)
+    return [
+        BaseModel('dense_nn', DenseNN, {
+            'hidden_dim': 64,
+            'num_layers': 1,
+            'l2_reg': 5e-5,
+            'epochs': 20,
+            'batch_size': 1024,
+            'dropout': 0.4
+        }, threads=keras_threads, memory_mb=2048),
+        boosting_base_model(hist_boosting),
+        BaseModel('abc', ABC, {
+            'n_estimators': 20,
+            'learning_rate': 1.0
+        }, binned=hist_boosting, memory_mb=1024),
+        BaseModel('lstm', MultiLSTMWithMetadata, lstm_args, meta_only=False, threads=keras_threads, memory_mb=8192)
+    ]
+
 
-    train_results[:, 3] = lstm_nn.predict(data_train).squeeze()
-    val_results[:, 3] = lstm_nn.predict(data_val).squeeze()
+def ensemble_fit_predict(hist_boosting=False, meta_learner=None, folds=4, random_state=0, concurrent=False,
+                         save_dir=None):
+    """
+    Fit the stacked ensemble on cached out-of-fold predictions and predict the test applicants with base
+    models fit on all training data. Only base models missing from the prediction cache are trained.
 
-    # lr = LogisticRegression(class_weight='balanced', C=0.1, fit_intercept=False)
-    # lr.fit(train_results, target_train.values)
-    # y = lr.predict(val_results)
+    :param meta_learner: optional classifier to stack the base models with
+    :param concurrent: train missing base models concurrently in separate processes
+    :param save_dir: optional directory to save the fitted loader state, base models and meta-learner to,
+    for scoring with ensemble_predict_saved
+    """
+    loader = HCDRDataLoader(**ENSEMBLE_LOADER_ARGS)
+    cache = OOFCache(loader, ENSEMBLE_LOADER_ARGS, concurrent=concurrent)
+    base_models = ensemble_base_models(hist_boosting)
 
-    weights = np.array([1.7, 3.0, 0.75, 0.35])
-    y = logistic.cdf(np.dot(val_results - 0.5, weights))
+    oof = cache.out_of_fold(base_models, folds=folds, random_state=random_state)
+    target = loader.get_target()
+    stacker = Stacker(meta_learner).fit(oof, target)
+    if meta_learner is None:
+        logging.debug('Stacking weights:\n{}'.format(stacker.weights()))
+
+    test = cache.test(base_models)
+    y = stacker.predict(test)
 
     results_path = 'data/results/results_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now())
-    results = pd.DataFrame({'SK_ID_CURR': loader.get_test_index().values, 'TARGET': y}).set_index('SK_ID_CURR')
+    results = pd.DataFrame({'SK_ID_CURR': test.index.values, 'TARGET': y}).set_index('SK_ID_CURR')
     results.to_csv(results_path)
 
-    raw_results = pd.DataFrame(np.concatenate([val_results, y.reshape(-1, 1)], axis=1))
+    raw_results = test.assign(prediction=y)
     raw_results.to_csv('data/results/raw_results{:%Y%m%d_%H%M%S}.csv'.format(datetime.now()))
 
+    if save_dir is not None:
+        # transformers fit on all training applicants, the same ones the saved base models were fit with
+        loader.load_train_data(load_time_series=False)
+        loader.save_state(os.path.join(save_dir, 'loader'))
+        Ensemble(cache.fitted_models(base_models), stacker).save(save_dir)
 
-def ensemble_fit_val():
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    return results
 
-    loader_args = {
-        'cc_tmax': 60,
-        'bureau_tmax': 60,
-        'pos_tmax': 60,
-        'install_mos_max': 60
-    }
 
-    loader = HCDRDataLoader(**loader_args)
-    app_ix = loader.get_index()
-    scores = np.zeros(4)
-    coefs = np.zeros((4, 4))
-    scores_path = 'data/results/ensemble_scores_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now())
+def ensemble_predict_saved(save_dir, data_dir='data'):
+    """
+    Score the test applicants with an ensemble saved by ensemble_fit_predict, restoring the fitted loader
+    instead of reading and fitting the training data
+    """
+    loader = HCDRInferenceLoader(os.path.join(save_dir, 'loader'), data_dir=data_dir)
+    ensemble = Ensemble.load(save_dir)
 
-    kf = KFold(n_splits=4, shuffle=True)
-    for j, fold_indexes in enumerate(kf.split(app_ix)):
-        # load training and test data
-        data_train, target_train, data_val, target_val = loader.load_train_val(fold_indexes[0], fold_indexes[1])
-        input_shape = loader.get_input_shape()
-
-        # oversample troubled loans to make up for imbalance
-        ros = RandomOverSampler()
-        os_index, target_train_os = ros.fit_sample(np.arange(data_train[0].shape[0]).reshape(-1, 1), target_train)
-        data_train_os = [data_train_part[os_index.squeeze()] for data_train_part in data_train]
-
-        # use predict on out of sample data and store results for each model
-        num_models = 4
-        train_samples = target_train.shape[0]
-        val_samples = target_val.shape[0]
-        train_results = np.empty((train_samples, num_models))
-        val_results = np.empty((val_samples, num_models))
-
-        # dense neural network
-        logging.debug('Training dense neural network')
-        model_args = {
-            'hidden_dim': 64,
-            'num_layers': 1,
-            'l2_reg': 5e-5,
-            'epochs': 20,
-            'batch_size': 1024,
-            'dropout': 0.4
-        }
-
-        dense_nn = DenseNN(data_train_os[0].shape[1], **model_args)
-        dense_nn.fit(data_train_os[0], target_train_os)
-
-        train_results[:, 0] = dense_nn.predict(data_train[0]).squeeze()
-        val_results[:, 0] = dense_nn.predict(data_val[0]).squeeze()
-
-        # gradient boosting classifier
-        logging.debug('Training gradient boosting classifier')
-        gbc = GBC(
-            max_depth=5,
-            n_estimators=30,
-            min_samples_split=0.01,
-            learning_rate=0.3
-        )
-        gbc.fit(data_train_os[0], target_train_os)
-
-        train_results[:, 1] = gbc.predict(data_train[0]).squeeze()
-        val_results[:, 1] = gbc.predict(data_val[0]).squeeze()
-
-        # adaboost classifier
-        logging.debug('Training adaboost classifier')
-        abc = ABC(
-            n_estimators=20,
-            learning_rate=1.0
-        )
-        abc.fit(data_train_os[0], target_train_os)
-
-        train_results[:, 2] = abc.predict(data_train[0]).squeeze()
-        val_results[:, 2] = abc.predict(data_val[0]).squeeze()
-
-        model_args = {
-            'epochs': 35,
-            'batch_size': 8192,
-            'lstm_gpu': True,
-            'sequence_dense_layers': 0,
-            'sequence_dense_width': 8,
-            'sequence_l2_reg': 0,
-            'meta_dense_layers': 3,
-            'meta_dense_width': 64,
-            'meta_l2_reg': 1e-5,
-            'meta_dropout': 0.2,
-            'comb_dense_layers': 3,
-            'comb_dense_width': 64,
-            'comb_l2_reg': 1e-5,
-            'comb_dropout': 0.1,
-            'lstm_units': 6,
-            'lstm_l2_reg': 1e-5
-        }
-
-        lstm_nn = MultiLSTMWithMetadata(input_shape, **model_args)
-
-        lstm_nn.fit(data_train_os, target_train_os, validation_data=(data_val, target_val))
-
-        train_results[:, 3] = lstm_nn.predict(data_train).squeeze()
-        val_results[:, 3] = lstm_nn.predict(data_val).squeeze()
-
-        lr = LogisticRegression(class_weight='balanced', C=0.1, fit_intercept=False)
-        lr.fit(train_results - 0.5, target_train.values)
-
-        y = lr.predict(val_results - 0.5)
-
-        # use logistic regression built-in scoring method to score out of sample accuracy
-        scores[j] = lr.score(val_results - 0.5, target_val.values)
-        # cm = confusion_matrix(target_val, y)
-
-        vlr = LogisticRegression(class_weight='balanced', C=0.1, fit_intercept=False)
-        vlr.fit(val_results - 0.5, target_val.values)
-        coefs[j, :] = vlr.coef_.squeeze()
-        coefs_path = 'data/results/ensemble_coef_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now())
-        coefs_df = pd.DataFrame(coefs)
-        coefs_df.to_csv(coefs_path)
-
-        results_path = 'data/results/results_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now())
-        results = pd.DataFrame({'TARGET': target_val.values, 'PREDICTION': y})
-        results.to_csv(results_path)
-
-        train_cls = pd.DataFrame(np.concatenate([train_results, target_train.values.reshape(-1, 1)], axis=1))
-        train_cls.to_csv('data/results/train_results_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now()))
-
-        raw_results = pd.DataFrame(np.concatenate([val_results, y.reshape(-1, 1), target_val.values.reshape(-1, 1)], axis=1))
-        raw_results.to_csv('data/results/val_results_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now()))
-
-        pd.DataFrame({'score': scores}).to_csv(scores_path)
-
-
-# TODO: add method for reading validation results from a file
-def ensemble_val_from_file(filename):
-    raw_results = pd.read_csv(filename)
-    raw_results.columns = [
-        'dense_nn',
-        'gbc',
-        'abc',
-        'lstm',
-        'target'
-    ]
+    data_test = loader.load_test_data(load_time_series=ensemble.needs_time_series())
+    y = ensemble.predict(data_test)
 
-    lr_params = {
-        'C': 1,
-        'class_weight': 'balanced',
-        'fit_intercept': False
-    }
+    results_path = 'data/results/results_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now())
+    results = pd.DataFrame({'SK_ID_CURR': loader.get_test_index().values, 'TARGET': y}).set_index('SK_ID_CURR')
+    results.to_csv(results_path)
+    return results
+
+
+def ensemble_score_chunks(save_dir, applications_path=None, chunk_rows=20000, data_dir='data'):
+    """
+    Score a file of applications chunk by chunk with an ensemble saved by ensemble_fit_predict. Each chunk
+    is transformed, predicted by every base model and blended, then appended to the results csv, so memory
+    stays flat in the number of applications. Side tables are sorted by applicant once and each chunk
+    reads only its applicants' rows.
+
+    :param applications_path: csv of applications in the layout of application_test.csv, by default
+    data_dir/application_test.csv
+    :param chunk_rows: number of applications scored at a time
+    :return: path of the results csv
+    """
+    ensemble = Ensemble.load(save_dir)
+    time_series = ensemble.needs_time_series()
+    loader = HCDRInferenceLoader(os.path.join(save_dir, 'loader'), data_dir=data_dir,
+                                 index_side_tables=time_series)
 
-    lr = LogisticRegression(**lr_params)
-    lr.fit(raw_results[['dense_nn', 'gbc', 'abc', 'lstm']], raw_results['target'])
+    results_path = 'data/results/results_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now())
+    # the results only appear under their name once every chunk is written
+    tmp_path = '{}.tmp'.format(results_path)
+    scored = 0
+    for applications in get_table_store(data_dir).read_chunks('application_test', chunk_rows, applications_path):
+        y = ensemble.predict(loader.transform_applications(applications, load_time_series=time_series))
+        results = pd.DataFrame({'SK_ID_CURR': applications['SK_ID_CURR'].values, 'TARGET': y})
+        results.to_csv(tmp_path, mode='w' if scored == 0 else 'a', header=scored == 0, index=False)
+        scored += len(results)
+        logging.debug('Scored {} applications'.format(scored))
+    os.replace(tmp_path, results_path)
+
+    return results_path
+
+
+def ensemble_fit_val(hist_boosting=False, meta_learner=None, folds=4, random_state=0, concurrent=False):
+    """
+    Validate the stacked ensemble by cross-validating the meta-learner on cached out-of-fold predictions
+    of the base models. Only base models and folds missing from the prediction cache are trained.
+
+    :param concurrent: train missing base models concurrently in separate processes
+    :return: DataFrame with the validation auc and stacking weights of each fold
+    """
+    loader = HCDRDataLoader(**ENSEMBLE_LOADER_ARGS)
+    cache = OOFCache(loader, ENSEMBLE_LOADER_ARGS, concurrent=concurrent)
+    base_models = ensemble_base_models(hist_boosting)
+
+    oof = cache.out_of_fold(base_models, folds=folds, random_state=random_state)
+    target = loader.get_target()
+    for name in oof.columns:
+        logging.debug('Out-of-fold auc of {}: {:.4f}'.format(name, roc_auc_score(target, oof[name])))
+
+    scores = Stacker(meta_learner).cross_validate(oof, target, folds=folds, random_state=random_state)
+    logging.debug('Stacking scores:\n{}'.format(scores))
+    scores.to_csv('data/results/ensemble_scores_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now()))
+
+    val_results = oof.assign(target=target.values)
+    val_results.to_csv('data/results/val_results_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now()))
+    return scores
+
+
+def ensemble_val_from_file(filename, meta_learner=None, folds=4, random_state=0):
+    """
+    Cross-validate a meta-learner on base model predictions saved by ensemble_fit_val, a column per base
+    model and a target column
+    """
+    val_results = pd.read_csv(filename, index_col=0)
+    target = val_results.pop('target')
+    scores = Stacker(meta_learner).cross_validate(val_results, target, folds=folds, random_state=random_state)
+    logging.debug('Stacking scores:\n{}'.format(scores))
+    return scores
 
 
 def gbc_grid_search():
@@ -287,6 +226,20 @@ def gbc_grid_search():
                 random_oversample=True)
 
 
+def hgb_grid_search():
+    loader_args = {
+        'load_time_series': False
+    }
+    model_args = {
+    }
+
+    # the binned meta data of each fold is cached and shared with the other tree model searches
+    grid_search(HGB, HCDRDataLoader,
+                hp_file='hgb_grid_params.txt',
+                loader_args=loader_args, model_args=model_args,
+                random_oversample=True, binned=True)
+
+
 def dense_nn_grid_search():
     loader_args = {
         'load_time_series': False
@@ -366,13 +319,69 @@ def multi_lstm_grid_search():
 
     model_args = {
         'batch_size': 512,
-        'lstm_gpu': True
+        'sequence_encoder': 'auto'
     }
 
+    # drop the weaker configurations after a third of the epochs on one fold
     grid_search(MultiLSTMWithMetadata, HCDRDataLoader,
                 hp_file='lstm_grid_params.txt',
                 loader_args=loader_args, model_args=model_args,
-                random_oversample=True)
+                random_oversample=True, strategy=SuccessiveHalving(resource='epochs', eta=3))
+
+
+def sequence_encoder_benchmark(epochs=3):
+    """
+    Train the multi lstm network with each sequence encoder the host supports on the same fold and
+    report the time per epoch and the validation auc of each.
+    """
+    loader_args = {
+        'cc_tmax': 60,
+        'bureau_tmax': 60,
+        'pos_tmax': 60
+    }
+
+    model_args = {
+        'epochs': epochs,
+        'batch_size': 8192,
+        'sequence_dense_layers': 0,
+        'meta_dense_layers': 3,
+        'meta_dense_width': 64,
+        'meta_l2_reg': 1e-5,
+        'meta_dropout': 0.2,
+        'comb_dense_layers': 3,
+        'comb_dense_width': 64,
+        'comb_l2_reg': 1e-5,
+        'comb_dropout': 0.1,
+        'lstm_units': 6,
+        'lstm_l2_reg': 1e-5
+    }
+
+    loader = HCDRDataLoader(**loader_args)
+    kf = KFold(n_splits=4, shuffle=True, random_state=0)
+    train_index, val_index = next(kf.split(loader.get_index()))
+    data_train, target_train, data_val, target_val = loader.load_train_val(train_index, val_index)
+    input_shape = loader.get_input_shape()
+
+    results = []
+    for sequence_encoder in available_sequence_encoders():
+        logging.debug('Benchmarking {} sequence encoder'.format(sequence_encoder))
+        epoch_timer = EpochTimer()
+        lstm_nn = MultiLSTMWithMetadata(input_shape, sequence_encoder=sequence_encoder, **model_args)
+        lstm_nn.fit(data_train, target_train, callbacks=[epoch_timer])
+
+        # first epoch includes graph tracing, leave it out of the average when there are others
+        epoch_times = epoch_timer.epoch_times[1:] or epoch_timer.epoch_times
+        results.append({
+            'sequence_encoder': sequence_encoder,
+            'epoch_time': np.mean(epoch_times),
+            'first_epoch_time': epoch_timer.epoch_times[0],
+            'val_auc': roc_auc_score(target_val, lstm_nn.predict(data_val).squeeze())
+        })
+        logging.debug(results[-1])
+
+    results_df = pd.DataFrame(results)
+    results_df.to_csv('data/results/encoder_benchmark_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now()))
+    return results_df
 
 
 if __name__ == "__main__":
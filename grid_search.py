@@ -1,20 +1,36 @@
+import os
+import json
+import time
 import logging
 import ast
+import tempfile
+import multiprocessing
 from datetime import datetime
 import itertools
 import numpy as np
 import pandas as pd
-from imblearn.over_sampling import RandomOverSampler
 from sklearn.model_selection import KFold
-from sklearn.metrics import confusion_matrix
+from sklearn.metrics import confusion_matrix, roc_auc_score
+from tensor_store import TensorStore
+from results_store import ResultsStore
+from stages import PeakMemory
+from search_strategies import GridStrategy
+from feature_bins import binned_features
+from job_scheduler import thread_limits
 
 
 def grid_search(model_class, data_loader, hp_file,
                 loader_args=None, model_args=None,
-                folds=4, random_oversample=False):
+                folds=4, random_oversample=False, workers=1, threads_per_job=None,
+                results_file='data/results/gridsearch_results.jsonl', random_state=0,
+                strategy=None, time_budget=None, binned=False):
     """
     Perform grid search over hyperparameters over given models.
 
+    Every (experiment, fold) result is appended to a results store as soon as it finishes, and pairs
+    the store already has a result for are skipped, so an interrupted search can be restarted with the
+    same arguments and picks up where it stopped.
+
     :param model_class:
     :param data_loader:
     :param loader_args:
@@ -22,8 +38,23 @@ def grid_search(model_class, data_loader, hp_file,
     :param hp_file:
     :param folds:
     :param random_oversample:
-    :return:
+    :param workers: number of (fold, experiment) jobs to run at once in separate processes, 1 to run
+    them one after another in this process
+    :param threads_per_job: blas and tensorflow threads for each job, defaults to sharing the cpus
+    between workers
+    :param results_file: json lines file with the result of every (experiment, fold) pair
+    :param random_state: seed of the fold split, kept fixed so restarted searches see the same folds
+    :param strategy: search strategy deciding which experiments run on which folds, such as
+    SuccessiveHalving, defaults to the full grid
+    :param time_budget: optional wall clock budget in seconds, no new jobs are started once it is spent
+    :param binned: train tree models on uint8 binned features, binned once per fold and shared by every
+    experiment and model class through the feature_bins cache
+    :return: DataFrame with the hyperparameters each experiment was last evaluated with and its results
     """
+    loader_args = loader_args or {}
+    model_args = model_args or {}
+    if binned and not getattr(model_class, 'binned_input', False):
+        raise ValueError('{} does not take binned features'.format(model_class.__name__))
     loader = data_loader(**loader_args)
 
     # load index values from main table
@@ -36,43 +67,277 @@ def grid_search(model_class, data_loader, hp_file,
     # create a list of dicts with hyperparameters for each experiment to run
     keys, values = zip(*hyperparameters.items())
     experiments = [dict(zip(keys, v)) for v in itertools.product(*values)]
-    exp_df = pd.DataFrame(experiments)
 
-    # prepare for storing confusion matrix and accuracy results to file
-    cm = np.zeros((len(experiments), 2, 2), dtype=int)
-    cm_df_cols = ['CM True Neg', 'CM False Pos', 'CM False Neg', 'CM True Pos']
+    store = ResultsStore(results_file)
+    model_name = model_class.__name__
+    kf = KFold(n_splits=folds, shuffle=True, random_state=random_state)
+    all_fold_splits = list(enumerate(kf.split(data_ix)))
+    deadline = None if time_budget is None else time.time() + time_budget
+
+    # hyperparameters each experiment was last evaluated with, strategies may cut their training short
+    evaluated = [None] * len(experiments)
+
+    def params_hash(experiment):
+        # experiments are identified by their hyperparameters and every setting that changes their results
+        settings = {'experiment': experiment,
+                    'model_args': model_args,
+                    'loader_args': loader_args,
+                    'folds': folds,
+                    'random_state': random_state,
+                    'random_oversample': random_oversample}
+        if binned:
+            settings['binned'] = True
+        return ResultsStore.params_hash(settings)
+
+    def evaluate(candidates, fold_numbers):
+        """
+        Run (experiment number, hyperparameters) candidates on the given folds and return the mean
+        validation auc of each, skipping pairs already in the results store
+        """
+        hashes = [params_hash(experiment) for _, experiment in candidates]
+        for i, experiment in candidates:
+            evaluated[i] = experiment
+        pending = [[k for k in range(len(candidates))
+                    if j in fold_numbers and (model_name, hashes[k], j) not in store] for j in range(folds)]
+        logging.debug('{} of {} experiment folds already done'.format(
+            len(candidates) * len(fold_numbers) - sum(len(fold_pending) for fold_pending in pending),
+            len(candidates) * len(fold_numbers)))
+
+        fold_splits = [(j, fold_indexes) for j, fold_indexes in all_fold_splits if pending[j]]
+        if deadline is not None and time.time() > deadline:
+            fold_splits = []
+        candidate_params = [experiment for _, experiment in candidates]
+
+        if workers > 1:
+            job_results = _parallel_jobs(model_class, loader, fold_splits, pending, candidate_params, model_args,
+                                         random_oversample, workers, threads_per_job, binned)
+        else:
+            job_results = _serial_jobs(model_class, loader, fold_splits, pending, candidate_params, model_args,
+                                       random_oversample, binned)
+
+        for k, j, result in job_results:
+            logging.debug('Fold {} of {} done for {}: auc {:.4f}, fit {:.1f}s, predict {:.1f}s'.format(
+                j + 1, folds, candidate_params[k], result['auc'], result['fit_time'], result['predict_time']))
+            store.append({'model': model_name, 'params_hash': hashes[k], 'fold': j,
+                          'params': candidate_params[k], **result})
+
+            # stop starting new jobs once the time budget is spent
+            if deadline is not None and time.time() > deadline:
+                logging.debug('Time budget of {}s spent, stopping search'.format(time_budget))
+                job_results.close()
+                break
+
+        scores = []
+        for hash_value in hashes:
+            aucs = [record['auc'] for record in store.records(model_name, hash_value) if record['fold'] in fold_numbers]
+            scores.append(np.mean(aucs) if aucs else np.nan)
+        return scores
+
+    (strategy or GridStrategy()).search(experiments, folds, evaluate)
+
+    # summarize all folds of every experiment as last evaluated, including folds run before a restart
     results_path = 'data/results/gridsearch_results_{:%Y%m%d_%H%M%S}.csv'.format(datetime.now())
+    final_params = [experiment if evaluated[i] is None else evaluated[i] for i, experiment in enumerate(experiments)]
+    exp_df = pd.DataFrame(final_params)
+    results_df = exp_df.join(_summarize_results([store.records(model_name, params_hash(experiment))
+                                                 for experiment in final_params]))
+    results_df.to_csv(results_path)
+    return results_df
+
+
+def _summarize_results(experiment_records):
+    cm_df_cols = ['CM True Neg', 'CM False Pos', 'CM False Neg', 'CM True Pos']
+    rows = []
+    for records in experiment_records:
+        cm = np.zeros((2, 2), dtype=int)
+        for record in records:
+            cm = cm + np.array(record['confusion_matrix'])
+        rows.append([*cm.ravel(),
+                     len(records),
+                     np.mean([record['auc'] for record in records]) if records else np.nan,
+                     np.mean([record['fit_time'] for record in records]) if records else np.nan,
+                     np.mean([record['predict_time'] for record in records]) if records else np.nan,
+                     max([record['peak_memory'] for record in records], default=np.nan)])
+    return pd.DataFrame(rows, columns=[*cm_df_cols, 'Folds', 'AUC', 'Fit Time', 'Predict Time', 'Peak Memory'])
+
+
+def _training_jobs(model_class, candidates, pending):
+    """
+    Group the pending candidates of a fold into training jobs of (hyperparameters to fit, [(candidate
+    number, stage)]). Candidates of models with a staged_param that only differ in it share one job,
+    fit at its largest value, and are measured on the model's staged predictions.
+    """
+    staged_param = getattr(model_class, 'staged_param', None)
+    groups = {}
+    for k in pending:
+        if staged_param is None or staged_param not in candidates[k]:
+            groups[('single', k)] = [k]
+            continue
+        other_params = {param: value for param, value in candidates[k].items() if param != staged_param}
+        groups.setdefault(json.dumps(other_params, sort_keys=True, default=str), []).append(k)
+
+    jobs = []
+    for group in groups.values():
+        if len(group) == 1:
+            jobs.append((candidates[group[0]], [(group[0], None)]))
+        else:
+            largest = max(candidates[k][staged_param] for k in group)
+            jobs.append(({**candidates[group[0]], staged_param: largest},
+                         [(k, candidates[k][staged_param]) for k in group]))
+    return jobs
+
+
+def _fit_and_score(model_class, input_shape, model_args, experiment, stages, data_train, target_train,
+                   data_val, target_val, random_oversample):
+    """
+    Fit one experiment on one fold and measure it on the validation data, either once or for each
+    (candidate number, stage) of stages from the model's staged predictions
+
+    :return: list of (candidate number, result)
+    """
+    # memory of this job only, not of the loader or earlier jobs of the same process
+    with PeakMemory() as memory:
+        model = model_class(input_shape, **model_args, **experiment)
+
+        # oversample to correct for class imbalance
+        start_time = time.time()
+        history = model.fit(data_train, target_train, validation_data=(data_val, target_val),
+                            balance_classes=random_oversample)
+        fit_time = time.time() - start_time
+
+        start_time = time.time()
+        if stages[0][1] is None:
+            predict_val = np.asarray(model.predict(data_val)).ravel()
+            stage_predictions = [(stages[0][0], predict_val, time.time() - start_time)]
+        else:
+            stage_predictions = []
+            predict_val = None
+            wanted = sorted(stages, key=lambda stage: stage[1])
+            for n, predict_val in enumerate(model.staged_predict(data_val), 1):
+                while wanted and wanted[0][1] == n:
+                    stage_predictions.append((wanted.pop(0)[0], np.asarray(predict_val).ravel(),
+                                              time.time() - start_time))
+                if not wanted:
+                    break
+            # boosting stopped early, so larger stages predict the same as the last one
+            for k, _ in wanted:
+                stage_predictions.append((k, np.asarray(predict_val).ravel(), time.time() - start_time))
 
-    # fit model using k-fold verification
-    kf = KFold(n_splits=folds, shuffle=True)
+    results = []
+    for k, predict_val, predict_time in stage_predictions:
+        try:
+            auc = roc_auc_score(target_val, predict_val)
+        except ValueError:
+            # only one class in the validation data
+            auc = np.nan
 
-    for j, fold_indexes in enumerate(kf.split(data_ix)):
+        result = {'fit_time': fit_time,
+                  'predict_time': predict_time,
+                  'peak_memory': memory.peak_rss,
+                  'memory_growth': memory.growth(),
+                  'confusion_matrix': confusion_matrix(target_val, predict_val.round(), labels=[0, 1]),
+                  'auc': auc}
+
+        # fit time is shared by every stage of a staged fit
+        if len(stage_predictions) > 1:
+            result['staged_fit'] = experiment
+
+        # out of sample metrics per epoch of keras models
+        if hasattr(history, 'history'):
+            result['history'] = history.history
+
+        results.append((k, result))
+    return results
+
+
+def _load_fold(loader, fold_indexes, binned=False):
+    data_train, target_train, data_val, target_val = loader.load_train_val(fold_indexes[0], fold_indexes[1])
+    if binned:
+        if isinstance(data_train, list):
+            raise ValueError('Binned features need a loader without time series inputs')
+        data_train, data_val = binned_features(data_train, data_val)
+    return data_train, target_train, data_val, target_val
+
+
+def _serial_jobs(model_class, loader, fold_splits, pending, experiments, model_args, random_oversample, binned=False):
+    """
+    Run the pending experiments of every fold one after another in this process and yield (experiment
+    number, fold number, result)
+    """
+    for j, fold_indexes in fold_splits:
         # load train and validation data
-        data_train, target_train, data_val, target_val = loader.load_train_val(fold_indexes[0], fold_indexes[1])
+        data_train, target_train, data_val, target_val = _load_fold(loader, fold_indexes, binned)
 
         # determine shape of input arrays
         input_shape = loader.get_input_shape()
 
-        # oversample to correct for class imbalance
-        if random_oversample:
-            ros = RandomOverSampler()
-            os_index, target_train = ros.fit_sample(np.arange(len(fold_indexes[0])).reshape(-1, 1), target_train)
-            if isinstance(data_train, list):
-                data_train = [data_train_part[os_index.squeeze()] for data_train_part in data_train]
-            else:
-                data_train = data_train[os_index.squeeze()]
-
-        logging.debug('Fold {} of {}'.format(j + 1, folds))
+        logging.debug('Fold {}'.format(j + 1))
 
-        for i, experiment in enumerate(experiments):
+        for experiment, stages in _training_jobs(model_class, experiments, pending[j]):
             logging.debug(experiment)
-            model = model_class(input_shape, **model_args, **experiment)
-            # TODO: track oos accuracy per epoch
-            history = model.fit(data_train, target_train, validation_data=(data_val, target_val))
-            predict_val = model.predict(data_val)
-
-            cm[i, :, :] = cm[i, :, :] + confusion_matrix(target_val, predict_val.round())
-            cm_df = pd.DataFrame(cm.reshape((cm.shape[0], 4)), columns=cm_df_cols)
-            results_df = exp_df.join(cm_df)
-            # TODO: also store run time
-            results_df.to_csv(results_path)
+            for k, result in _fit_and_score(model_class, input_shape, model_args, experiment, stages,
+                                            data_train, target_train, data_val, target_val, random_oversample):
+                yield k, j, result
+
+
+def _parallel_jobs(model_class, loader, fold_splits, pending, experiments, model_args, random_oversample,
+                   workers, threads_per_job=None, binned=False):
+    """
+    Run the pending (fold, experiment) pairs in a pool of worker processes and yield (experiment number,
+    fold number, result) as jobs finish.
+
+    Each fold's train and validation data is built once and written to a temporary tensor store, which
+    workers open memory-mapped, so all jobs of a fold share one read-only copy through the page cache
+    instead of receiving pickled arrays.
+    """
+    if threads_per_job is None:
+        threads_per_job = max(1, (os.cpu_count() or 1) // workers)
+
+    with tempfile.TemporaryDirectory(prefix='grid_search_') as fold_root:
+        fold_jobs = []
+        for j, fold_indexes in fold_splits:
+            data_train, target_train, data_val, target_val = _load_fold(loader, fold_indexes, binned)
+            fold_dir = os.path.join(fold_root, 'fold_{}'.format(j))
+            _save_fold(TensorStore(fold_dir), data_train, target_train, data_val, target_val)
+            fold_jobs.append((j, fold_dir, loader.get_input_shape(), isinstance(data_train, list)))
+            logging.debug('Fold {} data saved to {}'.format(j + 1, fold_dir))
+
+        jobs = [(j, model_class, model_args, experiment, stages, fold_dir, input_shape, multi_input, random_oversample)
+                for j, fold_dir, input_shape, multi_input in fold_jobs
+                for experiment, stages in _training_jobs(model_class, experiments, pending[j])]
+        if not jobs:
+            return
+
+        # spawned workers start with the thread limits set, as blas and tensorflow read them on import
+        with thread_limits(threads_per_job):
+            pool = multiprocessing.get_context('spawn').Pool(workers)
+
+        with pool:
+            for j, results in pool.imap_unordered(_fit_fold_experiment, jobs):
+                for k, result in results:
+                    yield k, j, result
+
+
+def _save_fold(store, data_train, target_train, data_val, target_val):
+    for split, data, target in [('train', data_train, target_train), ('val', data_val, target_val)]:
+        for k, data_part in enumerate(data if isinstance(data, list) else [data]):
+            store.save('{}_{}'.format(split, k), data_part,
+                       dtype=np.uint8 if data_part.dtype == np.uint8 else np.float32)
+        store.save('{}_target'.format(split), np.asarray(target))
+
+
+def _load_fold_split(store, split, input_shape, multi_input):
+    data = [store.load('{}_{}'.format(split, k)) for k in range(len(input_shape) if multi_input else 1)]
+    target = np.asarray(store.load('{}_target'.format(split))).astype(int)
+    return (data if multi_input else data[0]), target
+
+
+def _fit_fold_experiment(job):
+    j, model_class, model_args, experiment, stages, fold_dir, input_shape, multi_input, random_oversample = job
+
+    store = TensorStore(fold_dir)
+    data_train, target_train = _load_fold_split(store, 'train', input_shape, multi_input)
+    data_val, target_val = _load_fold_split(store, 'val', input_shape, multi_input)
+
+    return j, _fit_and_score(model_class, input_shape, model_args, experiment, stages,
+                             data_train, target_train, data_val, target_val, random_oversample)
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+GROUP_STATS = ('sum', 'count', 'min', 'max', 'mean')
+
+
+def group_aggregate(table, blocks, id_col='SK_ID_CURR', fill_value=None, chunk_columns=32, dummies=None,
+                    dummy_columns=None):
+    """
+    Aggregate the rows of a table by id in one pass over a single sort of the ids.
+
+    Rows are sorted once by id and every statistic is computed with ufunc reduceat over contiguous
+    groups, a few columns at a time so at most chunk_columns columns are copied at once. Statistics
+    skip na values like pandas: sums of groups without values are zero, counts are the number of
+    non-na values and min, max and mean are na (or fill_value) for groups without values.
+
+    :param table: DataFrame with an id column and numeric columns
+    :param blocks: list of (columns, stats) pairs, columns None for all columns but the id column and
+    stats any of 'sum', 'count', 'min', 'max' and 'mean'
+    :param fill_value: optional value for min, max and mean of groups without values
+    :param dummies: optional sparse one-hot matrix with the rows of table, e.g. from OneHotEncoder, its
+    columns follow those of the table and are aggregated from the sparse matrix
+    :param dummy_columns: names of the columns of dummies
+    :return: float32 DataFrame indexed by sorted unique id, with a column named column_stat for every
+    column and stat of every block, in block order
+    """
+    dummy_columns = list(dummy_columns) if dummies is not None else []
+    all_columns = [col for col in table.columns if col != id_col] + dummy_columns
+    blocks = [(all_columns if columns is None else list(columns), list(stats)) for columns, stats in blocks]
+    for _, stats in blocks:
+        unknown = set(stats) - set(GROUP_STATS)
+        if unknown:
+            raise ValueError('Unknown group statistics: {}'.format(sorted(unknown)))
+
+    # output layout and the stats needed for each input column
+    col_stats = [(col, stat) for columns, stats in blocks for col in columns for stat in stats]
+    out_columns = ['{}_{}'.format(col, stat) for col, stat in col_stats]
+    positions = {}
+    for i, (col, stat) in enumerate(col_stats):
+        positions.setdefault(col, {}).setdefault(stat, []).append(i)
+
+    # sort once by id and find the start of each group
+    ids = table[id_col].values
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])[:len(ids)]
+    group_ids = sorted_ids[starts]
+
+    # column-major so each output column is written contiguously, the layout pandas keeps blocks in
+    result = np.empty((len(group_ids), len(out_columns)), dtype=np.float32, order='F')
+    if len(group_ids) == 0 or len(out_columns) == 0:
+        return pd.DataFrame(result, index=pd.Index(group_ids, name=id_col), columns=out_columns)
+
+    # columns that need the same stats are aggregated together
+    by_stats = {}
+    dummy_positions = set(dummy_columns)
+    for col, stat_positions in positions.items():
+        if col not in dummy_positions:
+            by_stats.setdefault(frozenset(stat_positions), []).append(col)
+
+    for stats, columns in by_stats.items():
+        for start in range(0, len(columns), chunk_columns):
+            chunk = columns[start:start + chunk_columns]
+            values = table[chunk].to_numpy(dtype=np.float32)[order]
+            _write_stats(result, _reduce_groups(values, starts, stats, fill_value), chunk, positions)
+
+    # one-hot columns have no na values and every stat follows from the number of ones in each group
+    dummy_chunk = [col for col in dummy_columns if col in positions]
+    if dummy_chunk:
+        stats = set(stat for col in dummy_chunk for stat in positions[col])
+        used = [dummy_columns.index(col) for col in dummy_chunk]
+        _write_stats(result, _reduce_dummy_groups(dummies[:, used], ids, group_ids, starts, stats), dummy_chunk,
+                     positions)
+
+    return pd.DataFrame(result, index=pd.Index(group_ids, name=id_col), columns=out_columns)
+
+
+def _write_stats(result, reduced, chunk, positions):
+    for stat, stat_values in reduced.items():
+        # a column and stat can appear in more than one block
+        for k in range(max(len(positions[col].get(stat, [])) for col in chunk)):
+            targets = [(j, positions[col][stat][k]) for j, col in enumerate(chunk)
+                       if k < len(positions[col].get(stat, []))]
+            if targets:
+                source, target = zip(*targets)
+                result[:, list(target)] = stat_values[:, list(source)]
+
+
+def _reduce_dummy_groups(dummies, ids, group_ids, starts, stats):
+    # number of ones per group through a sparse group membership matrix, without densifying the rows
+    groups = np.searchsorted(group_ids, ids)
+    membership = csr_matrix((np.ones(len(ids), dtype=np.float64), (groups, np.arange(len(ids)))),
+                            shape=(len(group_ids), len(ids)))
+    ones = (membership @ dummies.astype(np.float64)).toarray()
+    rows = np.diff(np.r_[starts, len(ids)])[:, None].astype(np.float64)
+
+    reduced = {}
+    if 'sum' in stats:
+        reduced['sum'] = ones
+    if 'count' in stats:
+        reduced['count'] = np.broadcast_to(rows, ones.shape)
+    if 'mean' in stats:
+        reduced['mean'] = ones / rows
+    if 'min' in stats:
+        reduced['min'] = (ones == rows).astype(np.float64)
+    if 'max' in stats:
+        reduced['max'] = (ones > 0).astype(np.float64)
+    return reduced
+
+
+def _reduce_groups(values, starts, stats, fill_value):
+    # values are sorted by group, starts is the first row of each group
+    isnan = np.isnan(values)
+    has_nan = isnan.any()
+    reduced = {}
+
+    counts = None
+    if has_nan or 'count' in stats or 'mean' in stats:
+        counts = np.add.reduceat(~isnan, starts, axis=0, dtype=np.int64)
+    if 'count' in stats:
+        reduced['count'] = counts
+
+    if 'sum' in stats or 'mean' in stats:
+        sums = np.add.reduceat(np.where(isnan, 0, values) if has_nan else values, starts, axis=0,
+                               dtype=np.float64)
+        if 'sum' in stats:
+            reduced['sum'] = sums
+        if 'mean' in stats:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                reduced['mean'] = sums / counts
+    if 'min' in stats:
+        reduced['min'] = np.minimum.reduceat(np.where(isnan, np.inf, values) if has_nan else values, starts, axis=0)
+    if 'max' in stats:
+        reduced['max'] = np.maximum.reduceat(np.where(isnan, -np.inf, values) if has_nan else values, starts, axis=0)
+
+    # groups without any values have no min, max or mean
+    if has_nan:
+        empty = counts == 0
+        missing = np.nan if fill_value is None else fill_value
+        for stat in ('min', 'max', 'mean'):
+            if stat in reduced:
+                reduced[stat] = np.where(empty, missing, reduced[stat])
+
+    return reduced
@@ -0,0 +1,128 @@
+import os
+import time
+import queue
+import logging
+import traceback
+import contextlib
+import multiprocessing
+from stages import peak_rss
+
+# thread pools of blas and tensorflow, read once when they are imported
+THREAD_LIMIT_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                     'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']
+
+
+class Job:
+    """
+    Function call to run in its own process, with hints of the resources it needs
+    """
+    def __init__(self, name, target, args=(), threads=1, memory_mb=None):
+        """
+        :param name: name of the job, results are returned by name
+        :param target: module level function, so spawned processes can import it
+        :param args: arguments of target, pickled to the worker process
+        :param threads: number of threads the job may use
+        :param memory_mb: estimated peak memory of the job in MB, None if negligible
+        """
+        self.name = name
+        self.target = target
+        self.args = args
+        self.threads = threads
+        self.memory_mb = memory_mb or 0
+
+
+@contextlib.contextmanager
+def thread_limits(threads):
+    """
+    Set the thread limit variables while processes that should inherit them are started
+    """
+    saved_env = {var: os.environ.get(var) for var in THREAD_LIMIT_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_LIMIT_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def run_jobs(jobs, max_threads=None, max_memory_mb=None, poll_interval=1.0):
+    """
+    Run jobs concurrently, each in a fresh spawned process with its thread limits set, and yield
+    (name, result) as they finish.
+
+    Jobs are started in order of most threads first, since those are usually the longest, whenever
+    the threads and memory hints of the running jobs leave room for them. A job that needs more than
+    the limits runs once nothing else is running. Inputs are best shared through memory-mapped files
+    passed by path, only the arguments and the results are pickled.
+
+    :param jobs: list of Job
+    :param max_threads: threads available to all running jobs, None for one per cpu
+    :param max_memory_mb: memory available to all running jobs, None for the physical memory
+    """
+    if max_threads is None:
+        max_threads = os.cpu_count() or 1
+    if max_memory_mb is None:
+        max_memory_mb = _physical_memory_mb()
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    pending = sorted(jobs, key=lambda job: -job.threads)
+    running = {}
+
+    try:
+        while pending or running:
+            # start every pending job that fits next to the running ones
+            for job in list(pending):
+                used_threads = sum(j.threads for j, _ in running.values())
+                used_memory = sum(j.memory_mb for j, _ in running.values())
+                if running and (used_threads + job.threads > max_threads or
+                                used_memory + job.memory_mb > max_memory_mb):
+                    continue
+                threads = max(1, min(job.threads, max_threads))
+                with thread_limits(threads):
+                    process = context.Process(target=_run_job, args=(job.name, job.target, job.args, results))
+                    process.start()
+                running[job.name] = (job, process)
+                pending.remove(job)
+                logging.debug('Started job {} with {} threads in process {}'.format(job.name, threads, process.pid))
+
+            try:
+                name, result, usage, error = results.get(timeout=poll_interval)
+            except queue.Empty:
+                # a worker killed without reporting, e.g. out of memory, would otherwise hang the run
+                for name, (job, process) in running.items():
+                    if process.exitcode not in (None, 0):
+                        raise RuntimeError('Job {} exited with code {}'.format(name, process.exitcode))
+                continue
+
+            job, process = running.pop(name)
+            process.join()
+            if error is not None:
+                raise RuntimeError('Job {} failed:\n{}'.format(name, error))
+            logging.debug('Job {} finished in {:.1f}s, peak memory {:.0f} MB'.format(
+                name, usage['wall_time'], usage['peak_rss'] / 2 ** 20))
+            yield name, result
+    finally:
+        for job, process in running.values():
+            process.terminate()
+            process.join()
+
+
+def _run_job(name, target, args, results):
+    start_time = time.time()
+    try:
+        result = target(*args)
+    except Exception:
+        results.put((name, None, None, traceback.format_exc()))
+        return
+    results.put((name, result, {'wall_time': time.time() - start_time, 'peak_rss': peak_rss()}, None))
+
+
+def _physical_memory_mb():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (ValueError, AttributeError, OSError):
+        return float('inf')
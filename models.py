@@ -1,16 +1,32 @@
+import os
+import time
+import pickle
+import numpy as np
+import tensorflow as tf
 from tensorflow.keras.models import Sequential, Model
-from tensorflow.keras.layers import LSTM, Dense, Dropout, Input, Reshape, concatenate #CuDNNLSTM, 
+from tensorflow.keras.layers import LSTM, GRU, Conv1D, GlobalMaxPooling1D, Dense, Dropout, Input, Masking, concatenate
+from tensorflow.keras.callbacks import Callback
 from tensorflow.keras.regularizers import l2
-from sklearn.ensemble import AdaBoostClassifier, GradientBoostingClassifier
+from sklearn.ensemble import AdaBoostClassifier, GradientBoostingClassifier, HistGradientBoostingClassifier
 from sklearn.tree import DecisionTreeClassifier
+from sequences import MultiInputSequence
+from sampling import balanced_sample_weight
+from time_series import sequence_lengths
+
+# fitted models are saved into a directory, keras networks as weights of the same architecture and
+# sklearn models as the pickled estimator
+KERAS_WEIGHTS_FILE = 'weights.h5'
+ESTIMATOR_FILE = 'estimator.pkl'
 
 
 class DenseNN:
     def __init__(self, input_dim, hidden_dim=64, num_layers=1, l2_reg=0, 
                  epochs=5, batch_size=256, dropout=0, verbose=1):
+        self._input_dim = input_dim
         self._epochs = epochs
         self._batch_size = batch_size
         self._verbose = verbose
+        self._batch_predictor = None
         self._model = Sequential()
 
         for i in range(num_layers):
@@ -27,18 +43,41 @@ class DenseNN:
                             optimizer='Adam',
                             metrics=['accuracy'])
 
-    def fit(self, data_train, target_train, validation_data=None):
-        self._model.fit(data_train, target_train,
-                        epochs=self._epochs,
-                        batch_size=self._batch_size,
-                        validation_data=validation_data,
-                        verbose=self._verbose)
+    def fit(self, data_train, target_train, validation_data=None, balance_classes=False):
+        train_batches = MultiInputSequence([data_train], [(self._input_dim,)], target_train,
+                                           batch_size=self._batch_size, shuffle=True, balanced=balance_classes)
+        if validation_data is not None:
+            validation_data = MultiInputSequence([validation_data[0]], [(self._input_dim,)], validation_data[1],
+                                                 batch_size=self._batch_size)
+        return self._model.fit(train_batches,
+                               epochs=self._epochs,
+                               validation_data=validation_data,
+                               verbose=self._verbose)
 
     def predict(self, data):
-        return self._model.predict(data)
+        batches = MultiInputSequence([data], [(self._input_dim,)], batch_size=self._batch_size)
+        # a single batch, e.g. one applicant, skips the setup of the predict loop
+        if len(batches) == 1:
+            if self._batch_predictor is None:
+                self._batch_predictor = batch_predictor(self._model)
+            return self._batch_predictor(batches[0][0][0]).numpy()
+        return self._model.predict(batches)
+
+    def save(self, model_dir):
+        self._model.save_weights(os.path.join(model_dir, KERAS_WEIGHTS_FILE))
+
+    def load(self, model_dir):
+        self._model.load_weights(os.path.join(model_dir, KERAS_WEIGHTS_FILE))
+        return self
 
 
 class GBC:
+    # tree models split pre-binned uint8 features as well as raw ones
+    binned_input = True
+
+    # hyperparameter whose smaller values staged_predict reports from a single fit
+    staged_param = 'n_estimators'
+
     def __init__(self, input_shape=None, n_estimators=10, max_depth=3, verbose=0, min_samples_split=2, learning_rate=0.1):
         self._model = GradientBoostingClassifier(n_estimators=n_estimators,
                                                  max_depth=max_depth,
@@ -46,34 +85,124 @@ class GBC:
                                                  min_samples_split=min_samples_split,
                                                  learning_rate=learning_rate)
 
-    def fit(self, data_train, target_train, validation_data=None):
-        self._model.fit(data_train, target_train)
+    def fit(self, data_train, target_train, validation_data=None, balance_classes=False):
+        sample_weight = balanced_sample_weight(target_train) if balance_classes else None
+        self._model.fit(np.asarray(data_train), target_train, sample_weight=sample_weight)
 
     def predict(self, data):
-        return self._model.predict_proba(data)[:, 1]
+        return self._model.predict_proba(np.asarray(data))[:, 1]
+
+    def save(self, model_dir):
+        _save_estimator(self._model, model_dir)
+
+    def load(self, model_dir):
+        self._model = _load_estimator(model_dir)
+        return self
+
+    def staged_predict(self, data):
+        """
+        Predictions after each boosting stage, the same as fitting with n_estimators of 1, 2, ...
+        """
+        for predict_proba in self._model.staged_predict_proba(np.asarray(data)):
+            yield predict_proba[:, 1]
 
 
 class ABC:
+    binned_input = True
+    staged_param = 'n_estimators'
+
     def __init__(self, input_shape=None, n_estimators=10, learning_rate=1):
         self._model = AdaBoostClassifier(n_estimators=n_estimators,
                                          learning_rate=learning_rate)
 
-    def fit(self, data_train, target_train, validation_data=None):
-        self._model.fit(data_train, target_train)
+    def fit(self, data_train, target_train, validation_data=None, balance_classes=False):
+        sample_weight = balanced_sample_weight(target_train) if balance_classes else None
+        self._model.fit(np.asarray(data_train), target_train, sample_weight=sample_weight)
+
+    def predict(self, data):
+        return self._model.predict_proba(np.asarray(data))[:, 1]
+
+    def save(self, model_dir):
+        _save_estimator(self._model, model_dir)
+
+    def load(self, model_dir):
+        self._model = _load_estimator(model_dir)
+        return self
+
+    def staged_predict(self, data):
+        """
+        Predictions after each boosting stage, the same as fitting with n_estimators of 1, 2, ...
+        Boosting can stop before n_estimators when a stage fits the training data perfectly.
+        """
+        for predict_proba in self._model.staged_predict_proba(np.asarray(data)):
+            yield predict_proba[:, 1]
+
+
+class HGB:
+    """
+    Histogram gradient boosting, which bins every feature into at most 255 values before fitting and
+    is much faster than the exact splits of GBC on wide meta data. Also takes features already binned
+    by feature_bins.FeatureBinner.
+    """
+    binned_input = True
+    staged_param = 'n_estimators'
+
+    def __init__(self, input_shape=None, n_estimators=100, max_depth=None, learning_rate=0.1, max_leaf_nodes=31,
+                 min_samples_leaf=20, l2_regularization=0, max_bins=255, verbose=0):
+        self._model = HistGradientBoostingClassifier(max_iter=n_estimators,
+                                                     max_depth=max_depth,
+                                                     learning_rate=learning_rate,
+                                                     max_leaf_nodes=max_leaf_nodes,
+                                                     min_samples_leaf=min_samples_leaf,
+                                                     l2_regularization=l2_regularization,
+                                                     max_bins=max_bins,
+                                                     early_stopping=False,
+                                                     verbose=verbose)
+
+    def fit(self, data_train, target_train, validation_data=None, balance_classes=False):
+        sample_weight = balanced_sample_weight(target_train) if balance_classes else None
+        self._model.fit(np.asarray(data_train), target_train, sample_weight=sample_weight)
 
     def predict(self, data):
-        return self._model.predict_proba(data)[:, 1]
+        return self._model.predict_proba(np.asarray(data))[:, 1]
+
+    def save(self, model_dir):
+        _save_estimator(self._model, model_dir)
+
+    def load(self, model_dir):
+        self._model = _load_estimator(model_dir)
+        return self
+
+    def staged_predict(self, data):
+        """
+        Predictions after each boosting iteration, the same as fitting with n_estimators of 1, 2, ...
+        """
+        for predict_proba in self._model.staged_predict_proba(np.asarray(data)):
+            yield predict_proba[:, 1]
 
 
 class DTC:
+    binned_input = True
+
     def __init__(self, input_shape=None, class_weight='balanced', min_samples_split=2):
         self._model = DecisionTreeClassifier(class_weight=class_weight, min_samples_split=min_samples_split)
 
-    def fit(self, data_train, target_train, validation_data=None):
-        self._model.fit(data_train, target_train)
+    def fit(self, data_train, target_train, validation_data=None, balance_classes=False):
+        # balanced class weights already give the classes equal weight
+        sample_weight = None
+        if balance_classes and self._model.class_weight != 'balanced':
+            sample_weight = balanced_sample_weight(target_train)
+        self._model.fit(np.asarray(data_train), target_train, sample_weight=sample_weight)
 
     def predict(self, data):
-        return self._model.predict_proba(data)[:, 1]
+        return self._model.predict_proba(np.asarray(data))[:, 1]
+
+    def save(self, model_dir):
+        _save_estimator(self._model, model_dir)
+
+    def load(self, model_dir):
+        self._model = _load_estimator(model_dir)
+        return self
 
 
 class MultiLSTMWithMetadata:
@@ -82,16 +211,40 @@ class MultiLSTMWithMetadata:
                  sequence_dense_width=32, meta_dense_width=32, comb_dense_width=32,
                  sequence_l2_reg=0, meta_l2_reg=0, comb_l2_reg=0,
                  sequence_dropout=0, meta_dropout=0, comb_dropout=0,
-                 lstm_units=8, lstm_l2_reg=0, lstm_gpu=False,
-                 epochs=5, batch_size=256):
+                 lstm_units=8, lstm_l2_reg=0, lstm_gpu=False, sequence_encoder='auto',
+                 epochs=5, batch_size=256, workers=4, max_queue_size=10,
+                 mask_padding=False, length_buckets=0):
 
         """
         input_shapes: a list of tuples indicating shape of each input, meta first as
         shape (meta_features,) and then sequence shapes as (sequence_lengths, sequence_features)
+
+        Inputs are fed in batches by a MultiInputSequence, read by a pool of worker threads that
+        prefetch up to max_queue_size batches while the model trains.
+
+        With mask_padding the lstm layers skip the all-zero months before an applicant's history starts.
+        With length_buckets > 0 rows are also batched by sequence length into that many buckets and each
+        batch is only padded to its longest sequence, which implies mask_padding. The conv encoder can't
+        mask padding, so its predictions would depend on the other rows of a batch, and it raises a
+        ValueError with length_buckets > 0.
+
+        sequence_encoder selects the layer that encodes each sequence, one of SEQUENCE_ENCODERS or 'auto'
+        for the fastest one the host supports. lstm_gpu is kept for compatibility, the lstm encoder runs
+        the cuDNN kernel whenever a gpu is available.
         """
+        self._input_shapes = input_shapes
         self._num_seq_inputs = len(input_shapes) - 1
         self._num_epochs = epochs
         self._batch_size = batch_size
+        self._workers = workers
+        self._max_queue_size = max_queue_size
+        self._length_buckets = length_buckets
+        self._batch_predictor = None
+        mask_padding = mask_padding or length_buckets > 0
+        self._sequence_encoder = select_sequence_encoder(sequence_encoder)
+        if length_buckets > 0 and self._sequence_encoder == 'conv':
+            raise ValueError('The conv sequence encoder reads the zero padding of each batch, '
+                             'use length_buckets=0 or another encoder')
 
         lstm_inputs = []
         lstm_outputs = []
@@ -99,21 +252,20 @@ class MultiLSTMWithMetadata:
 
         # build up the lstm network for each time series input
         for i, sequence_shape in enumerate(input_shapes[1:]):
-            # lstm input and reshape from flat to sequence length x features shape
-            lstm_input = Input(shape=(sequence_shape[0] * sequence_shape[1],), 
-                               name='lstm_input_{}'.format(i))
+            # lstm input of shape sequence length x features, bucketed batches vary in length
+            if length_buckets > 0:
+                lstm_input = Input(shape=(None, sequence_shape[1]), name='lstm_input_{}'.format(i))
+            else:
+                lstm_input = Input(shape=sequence_shape, name='lstm_input_{}'.format(i))
             lstm_inputs.append(lstm_input)
 
-            reshaped_input = Reshape(sequence_shape, 
-                                     name='reshaped_input_{}'.format(i))(lstm_input)
+            # mask the zero padding before each sequence, convolutions take the fixed window's padding as is
+            sequence_input = lstm_input
+            if mask_padding and self._sequence_encoder != 'conv':
+                sequence_input = Masking(mask_value=0., name='masking_{}'.format(i))(lstm_input)
 
-            # lstm layer selected based on gpu acceleration
-            if lstm_gpu:
-                lstm = CuDNNLSTM(lstm_units, kernel_regularizer=l2(lstm_l2_reg),
-                                 name='lstm_{}'.format(i))(reshaped_input)
-            else:
-                lstm = LSTM(lstm_units, kernel_regularizer=l2(lstm_l2_reg),
-                            name='lstm_{}'.format(i))(reshaped_input)
+            lstm = sequence_encoder_layers(self._sequence_encoder, sequence_input, lstm_units, lstm_l2_reg,
+                                           name='lstm_{}'.format(i))
 
             # add dense layers to output of lstm
             for j in range(sequence_dense_layers):
@@ -149,17 +301,138 @@ class MultiLSTMWithMetadata:
                             loss_weights=[1.] + [0.2] * self._num_seq_inputs,
                             metrics=['accuracy'])
 
-    def fit(self, data_train, target_train, validation_data=None, verbose=2):
+    def fit(self, data_train, target_train, validation_data=None, verbose=2, lengths=None, callbacks=None,
+            balance_classes=False):
+        """
+        lengths: optional (n_rows, n_sequence_inputs) array of real sequence lengths as given by
+        the data loader's get_sequence_lengths, used for length buckets and computed from data if missing
+
+        balance_classes: oversample the minority class in every epoch while batches are drawn
+        """
         num_outputs = self._num_seq_inputs + 1
+        train_batches = MultiInputSequence(data_train, self._input_shapes, target_train, num_outputs=num_outputs,
+                                           batch_size=self._batch_size, shuffle=True, balanced=balance_classes,
+                                           **self._bucket_args(data_train, lengths))
         if validation_data is not None:
-            validation_data = (validation_data[0], [validation_data[1]] * num_outputs)
-        history = self._model.fit(data_train, [target_train] * num_outputs,
+            validation_data = MultiInputSequence(validation_data[0], self._input_shapes, validation_data[1],
+                                                 num_outputs=num_outputs, batch_size=self._batch_size,
+                                                 **self._bucket_args(validation_data[0]))
+        history = self._model.fit(train_batches,
                                   validation_data=validation_data,
-                                  epochs=self._num_epochs, batch_size=self._batch_size, verbose=verbose)
+                                  epochs=self._num_epochs, verbose=verbose, callbacks=callbacks,
+                                  workers=self._workers, max_queue_size=self._max_queue_size)
         return history
 
-    def predict(self, data):
-        return self._model.predict(data)[0]
+    def predict(self, data, lengths=None):
+        batches = MultiInputSequence(data, self._input_shapes, batch_size=self._batch_size,
+                                     **self._bucket_args(data, lengths))
+        if len(batches) == 1:
+            if self._batch_predictor is None:
+                self._batch_predictor = batch_predictor(self._model)
+            prediction = self._batch_predictor(batches[0][0])[0].numpy()
+        else:
+            prediction = self._model.predict(batches, workers=self._workers, max_queue_size=self._max_queue_size)[0]
+
+        # put predictions from length bucketed batches back in input order
+        ordered_prediction = np.empty_like(prediction)
+        ordered_prediction[batches.row_order()] = prediction
+        return ordered_prediction
+
+    def _bucket_args(self, data, lengths=None):
+        if self._length_buckets == 0:
+            return {}
+        if lengths is None:
+            lengths = np.stack([sequence_lengths(seq_data, seq_shape[0])
+                                for seq_data, seq_shape in zip(data[1:], self._input_shapes[1:])], axis=1)
+        return {'lengths': lengths, 'num_buckets': self._length_buckets}
+
+    def save(self, model_dir):
+        self._model.save_weights(os.path.join(model_dir, KERAS_WEIGHTS_FILE))
+
+    def load(self, model_dir):
+        self._model.load_weights(os.path.join(model_dir, KERAS_WEIGHTS_FILE))
+        return self
 
     def model_summary(self):
         return self._model.summary()
+
+
+def batch_predictor(model):
+    """
+    Predict a single small batch by calling the model in a traced function. predict and predict_on_batch
+    set up a dataset and a predict loop on every call, which takes longer than the model itself for a few
+    rows, e.g. one applicant scored by the scoring service.
+    """
+    # one trace for any number of rows, inputs are cast to the dtypes of the model inputs
+    specs = [tf.TensorSpec(model_input.shape, model_input.dtype) for model_input in model.inputs]
+    dtypes = [spec.dtype.as_numpy_dtype for spec in specs]
+    if len(specs) == 1:
+        traced = tf.function(lambda inputs: model(inputs, training=False), input_signature=specs)
+        return lambda inputs: traced(np.asarray(inputs, dtype=dtypes[0]))
+    traced = tf.function(lambda inputs: model(inputs, training=False), input_signature=[specs])
+    return lambda inputs: traced([np.asarray(x, dtype=dtype) for x, dtype in zip(inputs, dtypes)])
+
+
+SEQUENCE_ENCODERS = ['lstm', 'gru', 'conv']
+
+
+def available_sequence_encoders():
+    """
+    Sequence encoders the host supports, fastest first. Keras runs the lstm with the fused cuDNN kernel
+    on a gpu and with its generic kernel otherwise, so every encoder runs on every host.
+    """
+    return list(SEQUENCE_ENCODERS)
+
+
+def select_sequence_encoder(sequence_encoder='auto'):
+    available = available_sequence_encoders()
+    if sequence_encoder == 'auto':
+        return available[0]
+    if sequence_encoder not in SEQUENCE_ENCODERS:
+        raise ValueError('Unknown sequence encoder {}, expected one of {}'.format(sequence_encoder,
+                                                                                 SEQUENCE_ENCODERS))
+    return sequence_encoder
+
+
+def sequence_encoder_layers(sequence_encoder, sequence_input, units, l2_reg, name):
+    """
+    Encode a (batch, time, features) sequence to a (batch, units) vector
+    """
+    if sequence_encoder == 'lstm':
+        # default lstm arguments let keras pick the cuDNN kernel when a gpu is available
+        return LSTM(units, kernel_regularizer=l2(l2_reg), name=name)(sequence_input)
+    if sequence_encoder == 'gru':
+        return GRU(units, kernel_regularizer=l2(l2_reg), name=name)(sequence_input)
+
+    # stack of dilated causal convolutions covering the last 15 time steps, max pooled over time
+    x = sequence_input
+    for dilation_rate in [1, 2, 4]:
+        x = Conv1D(units, kernel_size=3, padding='causal', dilation_rate=dilation_rate, activation='relu',
+                   kernel_regularizer=l2(l2_reg), name='{}_conv_{}'.format(name, dilation_rate))(x)
+    return GlobalMaxPooling1D(name=name)(x)
+
+
+class EpochTimer(Callback):
+    """
+    Record the wall time of every training epoch
+    """
+    def __init__(self):
+        super().__init__()
+        self.epoch_times = []
+        self._epoch_start = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch_times.append(time.perf_counter() - self._epoch_start)
+
+
+def _save_estimator(estimator, model_dir):
+    with open(os.path.join(model_dir, ESTIMATOR_FILE), 'wb') as f:
+        pickle.dump(estimator, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_estimator(model_dir):
+    with open(os.path.join(model_dir, ESTIMATOR_FILE), 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+class OneHotEncoder:
+    """
+    One-hot encode the categorical (category or object) columns of a table with a vocabulary per column
+    learned once, so every subset of the table, e.g. a fold, the test applicants or a single applicant,
+    is encoded into the same columns.
+
+    Labels are kept in the order they first appear in the table the encoder is fit on, or in category
+    order for ordered categoricals, and na values are a label of their own if the table has any. Labels
+    not in the vocabulary are encoded as all zeros. Tables are encoded from their category codes into a
+    sparse uint8 matrix, without copies of the frame, with the columns in the layout of pd.get_dummies.
+    """
+    def __init__(self, na_label='Unspecified'):
+        """
+        :param na_label: label of na values
+        """
+        self._na_label = na_label
+        self._vocabularies = None
+
+    def fit(self, table):
+        self._vocabularies = []
+        for col in table.select_dtypes(include=['object', 'category']).columns:
+            values = table[col]
+            if values.dtype.name == 'category' and values.cat.ordered:
+                # e.g. tables sorted by the table store, which keep the order of the source table this way
+                labels = list(values.cat.categories)
+                if values.isna().any():
+                    labels.append(self._na_label)
+            else:
+                codes, uniques = self._codes(values)
+                used, first_rows = np.unique(codes, return_index=True)
+                labels = [uniques[code] if code >= 0 else self._na_label for code in used[np.argsort(first_rows)]]
+            self._vocabularies.append((col, pd.Index(labels)))
+        return self
+
+    def transform(self, table):
+        """
+        :return: sparse uint8 matrix of the one-hot columns, rows in the order of table
+        """
+        rows, cols = [], []
+        offset = 0
+        for col, labels in self._vocabularies:
+            positions = self._positions(table[col], labels)
+            found = positions >= 0
+            rows.append(np.flatnonzero(found))
+            cols.append(positions[found] + offset)
+            offset += len(labels)
+
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+        return csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)), shape=(len(table), offset))
+
+    def fit_transform(self, table):
+        return self.fit(table).transform(table)
+
+    def transform_frame(self, table):
+        """
+        Dense DataFrame of the other columns of table followed by the one-hot columns, as pd.get_dummies
+        """
+        dummies = pd.DataFrame(self.transform(table).toarray(), index=table.index, columns=self.columns())
+        return pd.concat([table.drop(self.categorical_columns(), axis=1), dummies], axis=1)
+
+    def categorical_columns(self):
+        return [col for col, _ in self._vocabularies]
+
+    def columns(self):
+        """
+        Names of the one-hot columns, column_label for every label of every categorical column
+        """
+        return ['{}_{}'.format(col, label) for col, labels in self._vocabularies for label in labels]
+
+    @staticmethod
+    def _codes(values):
+        # codes of the distinct values and the values themselves, na values have code -1
+        if values.dtype.name == 'category':
+            return values.cat.codes.values, values.cat.categories
+        return pd.factorize(values)
+
+    def _positions(self, values, labels):
+        # position of each value in the vocabulary, -1 if not in it
+        codes, uniques = self._codes(values)
+        lookup = np.append(labels.get_indexer(uniques), labels.get_indexer([self._na_label]))
+        return lookup[codes]
@@ -1,87 +1,141 @@
+import os
+import pickle
+import hashlib
 import pandas as pd
 import numpy as np
 import logging
-import itertools
-from sklearn.preprocessing import StandardScaler
 from soft_impute import SoftImpute
 from sklearn.decomposition import PCA
-from sklearn.linear_model import LinearRegression
 from scipy.sparse import csr_matrix
 from loader import DataLoader
+from table_store import get_table_store
+from time_series import monthly_tensor, flatten_feature_major, sequence_lengths
+from tensor_store import TensorStore, take_rows
+from group_stats import group_aggregate
+from one_hot import OneHotEncoder
+from feature_assembler import FeatureAssembler
+from sufficient_stats import ColumnMoments, CrossProducts, MomentScaler
+from stages import run_stages
+
+LOADER_STATE_FILE = 'loader_state.pkl'
+
+# application amounts imputed by linear regression, in the order each is inferred from the ones before
+AMOUNT_COLUMNS = ['AMT_CREDIT', 'AMT_GOODS_PRICE', 'AMT_ANNUITY']
 
 
 class HCDRDataLoader(DataLoader):
+    # fitted state saved by save_state and restored by HCDRInferenceLoader
+    _state_attributes = ['_cc_tmax', '_bureau_tmax', '_pos_tmax', '_install_mos_max', '_load_time_series',
+                         '_curr_home_imputer', '_st_pca', '_home_stat_cols', '_encoders', '_amt_gp_lr',
+                         '_amt_an_lr', '_mean_imp_cols', '_mean_imp_means', '_app_columns', '_meta_columns',
+                         '_num_scaler', '_install_width', '_install_days']
+    _state_tables = ['_home_stats', '_bureau_summary', '_previous_summary', '_bureau_balance_summary',
+                     '_cc_balance_summary', '_pos_cash_summary', '_installments_summary']
+
     def __init__(self, cc_tmax=25, bureau_tmax=25, pos_tmax=25, install_mos_max=30,
-                 data_dir='data', load_time_series=True):
+                 data_dir='data', load_time_series=True, mmap_tensors=False, stage_workers=1):
         super().__init__()
         logging.debug('Initializing data loader')
 
         # directory where input data is stored
         self._data_dir = data_dir
 
+        # each raw csv is parsed once per process and shared between stages and folds
+        self._tables = get_table_store(data_dir)
+
         # max number of months to analyze for each time series input
         self._cc_tmax = cc_tmax
         self._bureau_tmax = bureau_tmax
         self._pos_tmax = pos_tmax
         self._install_mos_max = install_mos_max
 
-        self._curr_home_imputer = SoftImpute()
-        self._amt_gp_lr = LinearRegression()
-        self._amt_an_lr = LinearRegression()
+        # fixed seed so every loader builds the same features and content keyed caches can be shared
+        self._curr_home_imputer = SoftImpute(random_state=0)
+        self._amt_gp_lr = None
+        self._amt_an_lr = None
         self._st_pca = None
-        self._num_scaler = StandardScaler()
+        self._num_scaler = None
 
         self._mean_imp_cols = None
         self._mean_imp_means = None
+        self._app_columns = None
+        self._meta_columns = None
+        self._home_stat_cols = None
+        self._home_stats = None
+
+        # sufficient statistics of all training applications, and the moments of the meta data last fit
+        self._train_statistics = None
+        self._meta_moments = None
 
-        self._applications = pd.read_csv('{}/application_train.csv'.format(data_dir), index_col="SK_ID_CURR")
-        self._applications_test = pd.read_csv('{}/application_test.csv'.format(data_dir), index_col="SK_ID_CURR")
+        # one-hot vocabulary of each table, learned once from the whole table
+        self._encoders = {}
+
+        self._applications = self._tables.read('application_train').set_index('SK_ID_CURR')
+        self._applications_test = self._tables.read('application_test').set_index('SK_ID_CURR')
         self.pca_all_home_stats()
-        self._bureau_summary = self.read_bureau()
-        self._previous_summary = self.read_previous_application()
-        self._bureau_balance_summary = self.bureau_balance_summary()
-        self._cc_balance_summary = self.cc_balance_summary()
-        self._pos_cash_summary = self.pos_cash_summary()
-        self._installments_summary = self.installments_summary()
+
+        # summaries of the other tables are independent of each other and built serially by default, more
+        # stage_workers fork a process per stage, which is only safe before tensorflow or blas start threads
+        summaries = run_stages({
+            'bureau': self.read_bureau,
+            'previous': self.read_previous_application,
+            'bureau_balance': self.bureau_balance_summary,
+            'cc_balance': self.cc_balance_summary,
+            'pos_cash': self.pos_cash_summary,
+            'installments': self.installments_summary
+        }, workers=stage_workers)
+        self._bureau_summary = summaries['bureau']
+        self._previous_summary = summaries['previous']
+        self._bureau_balance_summary = summaries['bureau_balance']
+        self._cc_balance_summary = summaries['cc_balance']
+        self._pos_cash_summary = summaries['pos_cash']
+        self._installments_summary = summaries['installments']
+        self._assembler = None
+        logging.debug('Memory saved by compact dtypes:\n{}'.format(self._tables.memory_report()))
 
         self._input_shape = None
         self._load_time_series = load_time_series
 
+        # sequence inputs for every train and test applicant and their real lengths, built on first use
+        self._ts_ids = None
+        self._ts_data = None
+        self._ts_lengths = None
+        self._install_width = None
+        self._install_days = None
+
+        # optionally keep sequence inputs and scaled meta data in memory-mapped files under the data dir
+        self._tensor_store = TensorStore(self._tensor_store_dir()) if mmap_tensors else None
+
     def get_index(self):
         return self._applications.index
 
     def get_test_index(self):
         return self._applications_test.index
 
+    def get_target(self):
+        return self._applications['TARGET']
+
     def load_train_data(self, split_index=None, fit_transform=True, load_time_series=None):
         if load_time_series is None:
             load_time_series = self._load_time_series
 
         # load each of the available data tables
         applications = self.read_applications(split_index, fit_transform=fit_transform)
-        joined_train = (applications
-                        .join(self._bureau_summary, rsuffix='_BUREAU')
-                        .join(self._previous_summary, rsuffix='_PREVIOUS')
-                        .join(self._bureau_balance_summary, rsuffix='_BUREAU_BALANCE')
-                        .join(self._cc_balance_summary, rsuffix='_CC_BALANCE')
-                        .join(self._pos_cash_summary, rsuffix='_POS_CASH')
-                        .join(self._installments_summary, rsuffix='_INSTALL'))
+        target_train = applications['TARGET']
 
-        full_data_train = joined_train.combine_first(joined_train.select_dtypes(include=[np.number]).fillna(0))
-
-        # split into features and target
-        meta_data_train = full_data_train.drop('TARGET', axis=1)
-        target_train = full_data_train['TARGET']
-
-        # scale to zero mean and unit variance
-        meta_data_train = self._num_scaler.fit_transform(meta_data_train.loc[:, meta_data_train.dtypes == np.number])
+        # features scaled to zero mean and unit variance
+        meta_data_train = self._meta_data(applications.drop('TARGET', axis=1), fit_transform=fit_transform)
         meta_data_shape = tuple([meta_data_train.shape[1]])
 
+        if self._tensor_store is not None:
+            meta_data_train = self._store_meta(meta_data_train, 'meta_train', applications.index.values)
+
         if load_time_series:
-            cc_data_train = self.read_credit_card_balance(self._applications.index.values[split_index])
-            bureau_data_train = self.read_bureau_balance(self._applications.index.values[split_index])
-            pos_cash_data_train = self.read_pos_cash(self._applications.index.values[split_index])
-            install_data_train = self.read_installments(self._applications.index.values[split_index])
+            sk_ids = self.get_index().values
+            if split_index is not None:
+                sk_ids = sk_ids[split_index]
+            cc_data_train, bureau_data_train, pos_cash_data_train, install_data_train = \
+                self.select_time_series(sk_ids)
 
             ts_data_shape = [tuple([self._cc_tmax, int(cc_data_train.shape[1] / self._cc_tmax)]),
                              tuple([self._bureau_tmax, int(bureau_data_train.shape[1] / self._bureau_tmax)]),
@@ -104,24 +158,22 @@ class HCDRDataLoader(DataLoader):
     def load_test_data(self, load_time_series=True):
         # load each of the available data tables
         applications = self.read_applications(split_index=None, fit_transform=False, test_data=True)
-        joined_train = (applications
-                        .join(self._bureau_summary, rsuffix='_BUREAU')
-                        .join(self._previous_summary, rsuffix='_PREVIOUS')
-                        .join(self._bureau_balance_summary, rsuffix='_BUREAU_BALANCE')
-                        .join(self._cc_balance_summary, rsuffix='_CC_BALANCE')
-                        .join(self._pos_cash_summary, rsuffix='_POS_CASH')
-                        .join(self._installments_summary, rsuffix='_INSTALL'))
-        meta_data_train = joined_train.combine_first(joined_train.select_dtypes(include=[np.number]).fillna(0))
+        return self._application_inputs(applications, load_time_series, store_name='meta_test')
 
+    def _application_inputs(self, applications, load_time_series, store_name=None):
+        """
+        Model inputs of cleaned applications, transformed with the fitted scaler and column layout
+        """
         # scale to zero mean and unit variance
-        meta_data_train = self._num_scaler.transform(meta_data_train.loc[:, meta_data_train.dtypes == np.number])
+        meta_data_train = self._meta_data(applications, fit_transform=False)
         meta_data_shape = tuple([meta_data_train.shape[1]])
 
+        if self._tensor_store is not None and store_name is not None:
+            meta_data_train = self._store_meta(meta_data_train, store_name, applications.index.values)
+
         if load_time_series:
-            cc_data_train = self.read_credit_card_balance(self.get_test_index().values)
-            bureau_data_train = self.read_bureau_balance(self.get_test_index().values)
-            pos_cash_data_train = self.read_pos_cash(self.get_test_index().values)
-            install_data_train = self.read_installments(self.get_test_index().values)
+            cc_data_train, bureau_data_train, pos_cash_data_train, install_data_train = \
+                self.select_time_series(applications.index.values)
 
             ts_data_shape = [tuple([self._cc_tmax, int(cc_data_train.shape[1] / self._cc_tmax)]),
                              tuple([self._bureau_tmax, int(bureau_data_train.shape[1] / self._bureau_tmax)]),
@@ -142,9 +194,191 @@ class HCDRDataLoader(DataLoader):
         logging.debug('Test data loaded with input shape {}'.format(self._input_shape))
         return data_train
 
+    def _meta_data(self, applications, fit_transform=True):
+        """
+        Scaled float32 meta data of cleaned applications: their numeric columns and the summaries of the
+        other tables joined by applicant, in the column layout seen when the scaler was fit
+        """
+        # the scaler is fit from the moments of the applications read with fit_transform
+        if fit_transform:
+            self._meta_columns = self._meta_layout(applications)
+            self._num_scaler = MomentScaler().fit_moments(self._meta_moments)
+
+        # one float32 matrix written block by block and scaled in place
+        meta_data = self._feature_assembler().assemble(applications, self._meta_columns)
+        return self._num_scaler.transform(meta_data, copy=False)
+
+    def _feature_assembler(self):
+        if self._assembler is None:
+            self._assembler = FeatureAssembler([(self._bureau_summary, '_BUREAU'),
+                                                (self._previous_summary, '_PREVIOUS'),
+                                                (self._bureau_balance_summary, '_BUREAU_BALANCE'),
+                                                (self._cc_balance_summary, '_CC_BALANCE'),
+                                                (self._pos_cash_summary, '_POS_CASH'),
+                                                (self._installments_summary, '_INSTALL')])
+        return self._assembler
+
+    def _meta_layout(self, applications):
+        """
+        Meta data columns of cleaned applications, or of their columns
+        """
+        columns = applications if isinstance(applications, pd.Index) else \
+            applications.select_dtypes(include=[np.number]).columns
+        return pd.Index(self._feature_assembler().columns(columns.drop('TARGET', errors='ignore')))
+
+    def _side_table(self, name, sk_ids=None, projection=None):
+        """
+        Rows of a side table sorted by applicant, only the rows of sk_ids if given. The rows of each
+        applicant are a slice of the table store's sorted copy, found through its index.
+        """
+        index = self._tables.index(name, projection=projection)
+        return index.table() if sk_ids is None else index.rows(sk_ids)
+
+    def _encoder(self, name, table=None):
+        """
+        One-hot encoder of a table, with the vocabulary of the whole table learned the first time it is used,
+        so summaries and time series of any set of applicants have the same columns
+
+        :param table: the whole table, by default the side table of that name
+        """
+        if name not in self._encoders:
+            self._encoders[name] = OneHotEncoder().fit(self._side_table(name) if table is None else table)
+        return self._encoders[name]
+
+    def _one_hot(self, table, name, drop=()):
+        """
+        The other columns of a table, without drop, and the sparse one-hot matrix and names of the one-hot
+        columns of its categorical columns, with the vocabulary of the named table
+        """
+        encoder = self._encoder(name)
+        columns = table.drop(list(drop) + encoder.categorical_columns(), axis=1)
+        return columns, encoder.transform(table), encoder.columns()
+
     def get_input_shape(self):
         return self._input_shape
 
+    def save_state(self, state_dir):
+        """
+        Save the fitted transformers, column layouts and summary tables for HCDRInferenceLoader. The
+        transformers saved are the ones fit by the last load_train_data with fit_transform, normally on
+        all training applicants.
+        """
+        if self._meta_columns is None:
+            raise ValueError('Load training data with fit_transform before saving the loader state')
+
+        # the one-hot vocabularies and installment periods of the time series inputs
+        if self._ts_data is None:
+            self.build_time_series()
+        for name in ['credit_card_balance', 'bureau_balance', 'POS_CASH_balance']:
+            self._encoder(name)
+        if self._install_days is None:
+            self.read_installments(np.unique(self._ts_ids))
+
+        store = TensorStore(state_dir)
+        columns = {}
+        for name in self._state_tables:
+            table = getattr(self, name)
+            store.save(name.lstrip('_'), table.values, ids=table.index.values, dtype=table.values.dtype)
+            columns[name] = list(table.columns)
+
+        state = {'attributes': {name: getattr(self, name) for name in self._state_attributes}, 'columns': columns}
+        with open(os.path.join(state_dir, LOADER_STATE_FILE), 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        logging.debug('Saved loader state to {}'.format(state_dir))
+
+    def build_time_series(self):
+        """
+        Build the credit card, bureau balance, pos cash and installment inputs once for every train and
+        test applicant, folds and test data are then row slices of these.
+        """
+        # rows follow the order of train then test applicants, so each of those is one contiguous block
+        self._ts_ids = np.concatenate([self.get_index().values, self.get_test_index().values])
+        ts_names = ['cc_balance', 'bureau_balance', 'pos_cash', 'installments']
+
+        if self._tensor_store is not None and all(name in self._tensor_store for name in ts_names + ['lengths']):
+            logging.debug('Loading memory-mapped time series inputs...')
+            self._ts_data = [self._tensor_store.load(name) for name in ts_names]
+            self._ts_lengths = np.asarray(self._tensor_store.load('lengths'), dtype=np.int32)
+            self._install_width = self._ts_data[3].shape[1]
+            return
+
+        logging.debug('Building time series inputs for all applicants...')
+        sorted_ids = np.unique(self._ts_ids)
+        sorted_rows = np.searchsorted(sorted_ids, self._ts_ids)
+        self._ts_data = [self.read_credit_card_balance(sorted_ids)[sorted_rows],
+                         self.read_bureau_balance(sorted_ids)[sorted_rows],
+                         self.read_pos_cash(sorted_ids)[sorted_rows],
+                         self.read_installments(sorted_ids).astype(np.float32)[sorted_rows]]
+        self._install_width = self._ts_data[3].shape[1]
+
+        # record the real number of months of history of each applicant in each table
+        ts_tmax = [self._cc_tmax, self._bureau_tmax, self._pos_tmax, self._ts_data[3].shape[1] // 2]
+        self._ts_lengths = np.stack([sequence_lengths(ts_data, tmax) for ts_data, tmax in zip(self._ts_data, ts_tmax)],
+                                    axis=1)
+
+        if self._tensor_store is not None:
+            self._ts_data = [self._tensor_store.save(name, ts_data, ids=self._ts_ids)
+                             for name, ts_data in zip(ts_names, self._ts_data)]
+            self._tensor_store.save('lengths', self._ts_lengths, ids=self._ts_ids)
+
+    def select_time_series(self, sk_ids):
+        """
+        Rows of each time series input for the given ids, in the same order as sk_ids. Memory-mapped
+        inputs are returned as views rather than copies.
+        """
+        if self._ts_data is None:
+            self.build_time_series()
+        return [take_rows(ts_data, self._time_series_rows(sk_ids)) for ts_data in self._ts_data]
+
+    def get_sequence_lengths(self, split_index=None, test_data=False):
+        """
+        Real sequence length of each applicant in each time series input, as an (n_applicants, 4) array
+        in the same row order as load_train_data or load_test_data
+        """
+        if self._ts_data is None:
+            self.build_time_series()
+        if test_data:
+            sk_ids = self.get_test_index().values
+        else:
+            sk_ids = self.get_index().values
+            if split_index is not None:
+                sk_ids = sk_ids[split_index]
+        return self._ts_lengths[self._time_series_rows(sk_ids)]
+
+    def _time_series_rows(self, sk_ids):
+        ts_sorter = np.argsort(self._ts_ids)
+        return ts_sorter[np.searchsorted(self._ts_ids, sk_ids, sorter=ts_sorter)]
+
+    def data_key(self):
+        """
+        Short hash of the time series windows and the content of the source tables, for caches of
+        anything built from this loader's data
+        """
+        tables = ['application_train', 'application_test', 'bureau', 'bureau_balance', 'credit_card_balance',
+                  'POS_CASH_balance', 'installments_payments']
+        key = [self._cc_tmax, self._bureau_tmax, self._pos_tmax, self._install_mos_max]
+        key += [self._tables.fingerprint(name)[2] + self._tables.schema(name).key() for name in tables]
+        return hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+
+    def _tensor_store_dir(self):
+        """
+        Tensor store directory keyed by the time series windows and the content of the source tables
+        """
+        return os.path.join(self._data_dir, 'tensors', self.data_key())
+
+    def _store_meta(self, meta_data, name, row_ids):
+        """
+        Write a scaled meta data matrix to the tensor store, keyed by its rows and the scaler state
+        """
+        key = hashlib.blake2b(digest_size=8)
+        key.update(np.ascontiguousarray(row_ids).tobytes())
+        key.update(self._num_scaler.mean_.tobytes())
+        key.update(self._num_scaler.scale_.tobytes())
+        name = '{}_{}'.format(name, key.hexdigest())
+        if name in self._tensor_store:
+            return self._tensor_store.load(name)
+        return self._tensor_store.save(name, meta_data, ids=row_ids)
+
     def read_applications(self, split_index=None, fit_transform=True, test_data=False):
         logging.debug('Preparing applications data...')
         if test_data:
@@ -155,6 +389,23 @@ class HCDRDataLoader(DataLoader):
         if split_index is not None:
             apps_clean = apps_clean.iloc[split_index]
 
+        return self._clean_applications(apps_clean, fit_transform, split_index=split_index, training=not test_data)
+
+    def _clean_applications(self, apps_clean, fit_transform=True, split_index=None, training=True):
+        """
+        :param split_index: rows of the training applications given, their imputation is fit from the
+        statistics of all training applications minus those of the other rows
+        :param training: the applications are training applications
+        """
+        apps_clean = self._clean_rows(apps_clean, fit_transform)
+        if fit_transform:
+            self._fit_imputation(self._application_statistics(apps_clean, split_index, training))
+        return self._impute(apps_clean)
+
+    def _clean_rows(self, apps_clean, fit_transform=True):
+        """
+        Clean each application on its own: count na values, encode categories and fill the bureau requests
+        """
         # track rows with high number of na values
         apps_clean['NA_COLS'] = apps_clean.isna().sum(axis=1)
 
@@ -164,22 +415,105 @@ class HCDRDataLoader(DataLoader):
 
         apps_clean[yn_cols] = self._yn_cols_to_boolean(apps_clean, yn_cols)
 
-        # identify encoded columns, fill na with unspecified and change to categorical
-        apps_clean = self._cat_data_dummies(apps_clean)
+        # one-hot encode categorical columns with the vocabulary of all training applications, so every fold
+        # has the same columns, the y/n columns are numbers by now
+        if 'applications' not in self._encoders:
+            self._encoder('applications', self._applications.drop(yn_cols, axis=1))
+        apps_clean = self._encoders['applications'].transform_frame(apps_clean)
+
+        # keep the columns seen when fit, so applications without some categories line up
+        if fit_transform:
+            self._app_columns = apps_clean.columns.drop('TARGET', errors='ignore')
+        else:
+            target = apps_clean.get('TARGET')
+            apps_clean = apps_clean.reindex(columns=self._app_columns, fill_value=0)
+            if target is not None:
+                apps_clean['TARGET'] = target
 
         # impute all credit bureau requests with zero, except past year with one
         app_credit_cols = apps_clean.columns[apps_clean.columns.str.contains('AMT_REQ_CREDIT_BUREAU')]
         apps_clean['AMT_REQ_CREDIT_BUREAU_YEAR'] = apps_clean['AMT_REQ_CREDIT_BUREAU_YEAR'].fillna(1)
         apps_clean[app_credit_cols] = apps_clean[app_credit_cols].fillna(0)
 
-        logging.debug('Performing linear regression on goods price and annuity amount...')
-        # fit linear regression to infer goods price and annuity amount from credit using linear regression
-        if fit_transform:
-            amt_lr_rows = apps_clean['AMT_GOODS_PRICE'].notna()
-            x = apps_clean.loc[amt_lr_rows]['AMT_CREDIT']
-            y = apps_clean.loc[amt_lr_rows]['AMT_GOODS_PRICE']
-            self._amt_gp_lr.fit(x.values.reshape(-1, 1), y)
+        return apps_clean
+
+    def _application_statistics(self, apps_clean, split_index=None, training=True):
+        """
+        Sufficient statistics of cleaned applications before imputation: ColumnMoments of their meta data
+        columns and CrossProducts of their credit, goods price and annuity amounts. The statistics of a
+        fold of the training applications are those of all training applications, computed once, minus
+        those of its held-out rows, so fitting every fold of a k-fold split reads each row about twice.
+        """
+        if training and split_index is not None:
+            held_out = np.ones(len(self._applications), dtype=bool)
+            held_out[split_index] = False
+            held_out = np.flatnonzero(held_out)
+            # every training row once, e.g. in another order, has the statistics of all training applications
+            if len(held_out) == 0 and len(apps_clean) == len(self._applications):
+                if self._train_statistics is None:
+                    self._train_statistics = self._block_statistics(apps_clean)
+                return self._train_statistics
+            # folds without repeated rows that are larger than their held-out rows
+            if 0 < len(held_out) < len(apps_clean) and len(held_out) + len(apps_clean) == len(self._applications):
+                if self._train_statistics is None:
+                    self._train_statistics = self._block_statistics(self._applications, raw=True)
+                held_out_statistics = self._block_statistics(self._applications.iloc[held_out], raw=True)
+                return tuple(total - block for total, block in zip(self._train_statistics, held_out_statistics))
+
+        statistics = self._block_statistics(apps_clean)
+        if training and split_index is None:
+            self._train_statistics = statistics
+        return statistics
+
+    def _block_statistics(self, applications, raw=False, block_rows=50000):
+        """
+        Statistics of applications added up over blocks of rows, so only a block is cleaned and assembled
+        at a time
+
+        :param raw: the applications are not cleaned yet
+        """
+        moments, products = None, None
+        for start in range(0, len(applications), block_rows):
+            block = applications.iloc[start:start + block_rows]
+            if raw:
+                block = self._clean_rows(block.copy(), fit_transform=False)
+            meta_data = self._feature_assembler().assemble(block, self._meta_layout(block), na_applications=True)
+            block_moments = ColumnMoments.of(meta_data)
+            block_products = CrossProducts.of(block[AMOUNT_COLUMNS].to_numpy(np.float64))
+            moments = block_moments if moments is None else moments + block_moments
+            products = block_products if products is None else products + block_products
+        return moments, products
+
+    def _fit_imputation(self, statistics):
+        """
+        Fit the amount regressions and mean imputation of cleaned applications, and the moments the scaler
+        of their meta data is fit on, from their sufficient statistics
+        """
+        moments, products = statistics
+        credit, goods_price, annuity = range(len(AMOUNT_COLUMNS))
 
+        logging.debug('Performing linear regression on goods price and annuity amount...')
+        # infer goods price from credit, then annuity amount from credit and the goods price filled in
+        self._amt_gp_lr = products.regression(goods_price, [credit])
+        products = products.fill(goods_price, [credit], self._amt_gp_lr)
+        self._amt_an_lr = products.regression(annuity, [credit, goods_price])
+        products = products.fill(annuity, [credit, goods_price], self._amt_an_lr)
+
+        # moments of the amounts once filled in
+        layout = self._meta_layout(self._app_columns)
+        for i, col in enumerate(AMOUNT_COLUMNS):
+            moments = moments.with_column(layout.get_loc(col), *products.moments(i))
+
+        # basic mean imputation of remaining na values, which leaves the mean of each column as it is
+        positions = layout.get_indexer(self._app_columns)
+        self._mean_imp_cols = self._app_columns[moments.missing()[positions] > 0]
+        self._mean_imp_means = pd.Series(moments.means()[positions], index=self._app_columns)[self._mean_imp_cols]
+        self._meta_moments = moments
+
+    def _impute(self, apps_clean):
+        """
+        Fill the amounts and remaining na values of cleaned applications with the fitted imputation
+        """
         # use fitted linear regression to predict goods price
         amt_fill_rows = apps_clean['AMT_GOODS_PRICE'].isna()
         if sum(amt_fill_rows) > 0:
@@ -187,13 +521,6 @@ class HCDRDataLoader(DataLoader):
             y = self._amt_gp_lr.predict(x.values.reshape(-1, 1))
             apps_clean.loc[amt_fill_rows, 'AMT_GOODS_PRICE'] = y
 
-        # fit linear regression for annuity amount using credit amount and goods price
-        if fit_transform:
-            amt_lr_rows = apps_clean['AMT_ANNUITY'].notna()
-            x = apps_clean.loc[amt_lr_rows][['AMT_CREDIT', 'AMT_GOODS_PRICE']]
-            y = apps_clean.loc[amt_lr_rows]['AMT_ANNUITY']
-            self._amt_an_lr.fit(x.values, y)
-
         # use fitted linear regression to predict annuity amount
         amt_fill_rows = apps_clean['AMT_ANNUITY'].isna()
         if sum(amt_fill_rows) > 0:
@@ -202,10 +529,6 @@ class HCDRDataLoader(DataLoader):
             apps_clean.loc[amt_fill_rows, 'AMT_ANNUITY'] = y
 
         # basic mean imputation of remaining na values
-        if fit_transform:
-            self._mean_imp_cols = apps_clean.columns[apps_clean.isna().sum(axis=0) > 0]
-            self._mean_imp_means = apps_clean[self._mean_imp_cols].mean()
-
         apps_clean[self._mean_imp_cols] = apps_clean[self._mean_imp_cols].fillna(self._mean_imp_means)
 
         return apps_clean
@@ -220,8 +543,9 @@ class HCDRDataLoader(DataLoader):
         stat_test = self._applications_test[stat_cols]
         stat_full = pd.concat([stat_train, stat_test])
 
-        stat_full = self._cat_data_dummies(stat_full)
+        stat_full = self._encoder('home_stats', stat_full).transform_frame(stat_full)
         stat_index = stat_full.index.values
+        self._home_stat_cols = stat_cols
 
         logging.debug('Performing soft impute on current home info...')
         self._curr_home_imputer.fit(stat_full.values)
@@ -237,6 +561,7 @@ class HCDRDataLoader(DataLoader):
         home_stats_pca = pd.DataFrame(self._st_pca.transform(stat_full),
                                       index=stat_index,
                                       columns=pca_cols)
+        self._home_stats = home_stats_pca
 
         stat_pca_train = pd.DataFrame(home_stats_pca.loc[self.get_index().values],
                                       index=self.get_index().values,
@@ -253,15 +578,12 @@ class HCDRDataLoader(DataLoader):
 
     def read_bureau(self):
         # read in credit bureau data
-        bureau = pd.read_csv('{}/bureau.csv'.format(self._data_dir))
+        bureau = self._side_table('bureau')
 
-        # convert categorical columns to dummy values
-        bureau = self._cat_data_dummies(bureau)
+        # one-hot encode categorical columns
+        bureau, dummies, dummy_columns = self._one_hot(bureau, 'bureau', drop=['SK_ID_BUREAU'])
 
         # group by id and aggregate statistics
-        bureau_sum = bureau.drop('SK_ID_BUREAU', axis=1).groupby('SK_ID_CURR').agg(['sum'])
-        bureau_sum.columns = ['_'.join(a) for a in itertools.product(*bureau_sum.columns.levels)]
-
         agg_cols = [
             'DAYS_CREDIT',
             'CREDIT_DAY_OVERDUE',
@@ -276,22 +598,17 @@ class HCDRDataLoader(DataLoader):
             'DAYS_CREDIT_UPDATE',
             'AMT_ANNUITY'
         ]
-        bureau_agg = bureau.groupby('SK_ID_CURR')[agg_cols].agg(['max', 'min', 'mean']).fillna(0)
-        bureau_agg.columns = ['_'.join(a) for a in itertools.product(*bureau_agg.columns.levels)]
-
-        bureau_summary = bureau_sum.join(bureau_agg)
+        bureau_summary = group_aggregate(bureau, [(None, ['sum']), (agg_cols, ['max', 'min', 'mean'])], fill_value=0,
+                                         dummies=dummies, dummy_columns=dummy_columns)
         return bureau_summary
 
     def read_previous_application(self):
-        prev_app = pd.read_csv('{}/previous_application.csv'.format(self._data_dir))
+        prev_app = self._side_table('previous_application')
 
-        # convert categorical columns to dummy values
-        prev_app = self._cat_data_dummies(prev_app)
-
-        # create summary of the data and join them together
-        prev_app_sum = prev_app.drop('SK_ID_PREV', axis=1).groupby('SK_ID_CURR').agg(['sum'])
-        prev_app_sum.columns = ['_'.join(a) for a in itertools.product(*prev_app_sum.columns.levels)]
+        # one-hot encode categorical columns
+        prev_app, dummies, dummy_columns = self._one_hot(prev_app, 'previous_application')
 
+        # create summary of the data
         agg_cols = [
             'AMT_ANNUITY',
             'AMT_APPLICATION',
@@ -313,189 +630,136 @@ class HCDRDataLoader(DataLoader):
             'DAYS_TERMINATION',
             'NFLAG_INSURED_ON_APPROVAL'
         ]
-        prev_app_agg = prev_app.groupby('SK_ID_CURR')[agg_cols].agg(['max', 'min', 'mean']).fillna(0)
-        prev_app_agg.columns = ['_'.join(a) for a in itertools.product(*prev_app_agg.columns.levels)]
-
-        prev_app_summary = prev_app_sum.join(prev_app_agg)
+        prev_app_summary = group_aggregate(prev_app, [(None, ['sum']), (agg_cols, ['max', 'min', 'mean'])],
+                                           fill_value=0, dummies=dummies, dummy_columns=dummy_columns)
         return prev_app_summary
 
     def read_credit_card_balance(self, sk_ids=None):
         # read cc balance csv and full list of id values
         logging.debug('Reading credit card balance file...')
-        credit_card_balance = pd.read_csv('{}/credit_card_balance.csv'.format(self._data_dir))
-        app_ix = self.get_index()
-
-        # convert categorical columns to dummy values
-        credit_card_balance = self._cat_data_dummies(credit_card_balance)
-
-        # skim unused ids from input data
         if sk_ids is None:
-            sk_ids = app_ix.values
-        credit_card_balance = credit_card_balance[credit_card_balance['SK_ID_CURR'].isin(sk_ids)]
+            sk_ids = self.get_index().values
+        credit_card_balance = self._side_table('credit_card_balance', sk_ids)
 
-        # fill missing id values
-        missing_ids = sk_ids[~np.isin(sk_ids, credit_card_balance['SK_ID_CURR'].unique())]
-        missing_df = pd.DataFrame({'SK_ID_CURR': missing_ids})
-        missing_df['MONTHS_BALANCE'] = -1
+        # one-hot encode categorical columns
+        credit_card_balance, dummies, _ = self._one_hot(credit_card_balance, 'credit_card_balance')
 
-        # mix it all around
+        # sum each month for the given ids, ids without data are left as zeros
         logging.debug('Preparing credit card balance data...')
-        cc_ts_summary = (credit_card_balance
-                         .append(missing_df)
-                         .drop(['SK_ID_PREV'], axis=1)
-                         .fillna(0)
-                         .groupby(['SK_ID_CURR', 'MONTHS_BALANCE']).sum()
-                         .unstack(level=0).reindex(np.arange(-self._cc_tmax, 0)).stack(dropna=False)
-                         .swaplevel(0, 1).sort_index().unstack())
+        _, cc_ts_tensor = monthly_tensor(credit_card_balance, sk_ids, self._cc_tmax, dummies=dummies)
 
         logging.debug('Sparsifying...')
-        cc_ts_sparse = csr_matrix(cc_ts_summary.fillna(0).values)
+        cc_ts_sparse = csr_matrix(flatten_feature_major(cc_ts_tensor))
 
         logging.debug('Done')
         return cc_ts_sparse
 
     def cc_balance_summary(self):
         # read credit card balance csv
-        cc_balance = pd.read_csv('data/credit_card_balance.csv')
+        cc_balance = self._side_table('credit_card_balance')
 
-        # convert categorical columns to dummy values
-        cc_balance = self._cat_data_dummies(cc_balance)
+        # one-hot encode categorical columns
+        cc_balance, dummies, dummy_columns = self._one_hot(cc_balance, 'credit_card_balance', drop=['MONTHS_BALANCE'])
 
         # group by id and aggregate statistics for each column
-        cc_balance_sum = (cc_balance
-                          .drop(['MONTHS_BALANCE', 'SK_ID_PREV'], axis=1)
-                          .groupby('SK_ID_CURR')
-                          .agg(['sum', 'min', 'max', 'mean']))
-        cc_balance_sum.columns = ['_'.join(a) for a in itertools.product(*cc_balance_sum.columns.levels)]
+        cc_balance_sum = group_aggregate(cc_balance, [(None, ['sum', 'min', 'max', 'mean'])], dummies=dummies,
+                                         dummy_columns=dummy_columns)
 
         return cc_balance_sum
 
     def read_bureau_balance(self, sk_ids=None):
         logging.debug('Preparing credit bureau balance data...')
 
-        # read bureau balance csv and full list of id values
-        bureau_balance = pd.read_csv('{}/bureau_balance.csv'.format(self._data_dir))
-        bureau = pd.read_csv('data/bureau.csv')
-        id_xref = bureau[['SK_ID_CURR', 'SK_ID_BUREAU']]
-        app_ix = self.get_index()
-
-        # merge bureau ids with application ids
-        bureau_balance = bureau_balance.merge(id_xref).drop(['SK_ID_BUREAU'], axis=1)
-
-        # convert categorical columns to dummy values
-        bureau_balance = self._cat_data_dummies(bureau_balance)
-
-        # skim unused ids from input data
+        # read bureau balance rows of the given ids, bureau balance ids are mapped to application ids by the index
         if sk_ids is None:
-            sk_ids = app_ix.values
-        bureau_balance = bureau_balance[bureau_balance['SK_ID_CURR'].isin(sk_ids)]
+            sk_ids = self.get_index().values
+        bureau_balance = self._side_table('bureau_balance', sk_ids)
 
-        # fill missing id values
-        missing_ids = sk_ids[~np.isin(sk_ids, bureau_balance['SK_ID_CURR'].unique())]
-        missing_df = pd.DataFrame({'SK_ID_CURR': missing_ids})
-        missing_df['MONTHS_BALANCE'] = -1
+        # one-hot encode categorical columns
+        bureau_balance, dummies, _ = self._one_hot(bureau_balance, 'bureau_balance', drop=['SK_ID_BUREAU'])
 
-        bureau_ts_summary = (bureau_balance
-                             .append(missing_df)
-                             .fillna(0)
-                             .groupby(['SK_ID_CURR', 'MONTHS_BALANCE']).sum()
-                             .unstack(level=0).reindex(np.arange(-self._bureau_tmax, 0)).stack(dropna=False)
-                             .swaplevel(0, 1).sort_index().unstack())
+        # sum each month for the given ids, ids without data are left as zeros
+        _, bureau_ts_tensor = monthly_tensor(bureau_balance, sk_ids, self._bureau_tmax, dummies=dummies)
 
         logging.debug('Sparsifying...')
-        bureau_sparse = csr_matrix(bureau_ts_summary.fillna(0).values)
+        bureau_sparse = csr_matrix(flatten_feature_major(bureau_ts_tensor))
 
         logging.debug('Done')
         return bureau_sparse
 
     def bureau_balance_summary(self):
-        # read bureau balance csv and full list of id values
-        bureau_balance = pd.read_csv('{}/bureau_balance.csv'.format(self._data_dir))
-        # TODO: make id xref a class variable
-        bureau = pd.read_csv('data/bureau.csv')
-        id_xref = bureau[['SK_ID_CURR', 'SK_ID_BUREAU']]
-
-        # merge bureau ids with application ids
-        bureau_balance = bureau_balance.merge(id_xref).drop(['SK_ID_BUREAU'], axis=1)
+        # read bureau balance with the application id of each bureau id
+        bureau_balance = self._side_table('bureau_balance')
 
-        # convert categorical columns to dummy values
-        bureau_balance = self._cat_data_dummies(bureau_balance)
+        # one-hot encode categorical columns
+        bureau_balance, dummies, dummy_columns = self._one_hot(bureau_balance, 'bureau_balance',
+                                                               drop=['SK_ID_BUREAU', 'MONTHS_BALANCE'])
 
         # group by id and sum for each column
-        bureau_bal_sum = bureau_balance.drop('MONTHS_BALANCE', axis=1).groupby('SK_ID_CURR').agg(['sum'])
-        bureau_bal_sum.columns = ['_'.join(col_name) for col_name in itertools.product(*bureau_bal_sum.columns.levels)]
+        bureau_bal_sum = group_aggregate(bureau_balance, [(None, ['sum'])], dummies=dummies,
+                                         dummy_columns=dummy_columns)
 
         return bureau_bal_sum
 
     def read_pos_cash(self, sk_ids=None):
         logging.debug('Preparing POS cash data...')
 
-        # read pos cash csv and full list of id values
-        pos_cash = pd.read_csv('data/POS_CASH_balance.csv')
-        bureau = pd.read_csv('data/bureau.csv')
-        id_xref = bureau[['SK_ID_CURR', 'SK_ID_BUREAU']]
-        app_ix = self.get_index()
-
-        pos_cash = pos_cash.merge(id_xref)
-        pos_cash = self._cat_data_dummies(pos_cash).drop(['SK_ID_BUREAU', 'SK_ID_PREV'], axis=1)
-
+        # read pos cash rows of the given ids
         if sk_ids is None:
-            sk_ids = app_ix.values
-        pos_cash = pos_cash[pos_cash['SK_ID_CURR'].isin(sk_ids)]
+            sk_ids = self.get_index().values
+        pos_cash = self._side_table('POS_CASH_balance', sk_ids)
+        id_xref = self._side_table('bureau', sk_ids, projection='id_xref')
 
-        # fill missing id values
-        missing_ids = sk_ids[~np.isin(sk_ids, pos_cash['SK_ID_CURR'].unique())]
-        missing_df = pd.DataFrame({'SK_ID_CURR': missing_ids})
-        missing_df['MONTHS_BALANCE'] = -1
+        pos_cash = pos_cash.merge(id_xref)
+        pos_cash, dummies, _ = self._one_hot(pos_cash, 'POS_CASH_balance', drop=['SK_ID_BUREAU'])
 
-        pos_cash_summary = (pos_cash
-                            .append(missing_df)
-                            .fillna(0)
-                            .groupby(['SK_ID_CURR', 'MONTHS_BALANCE']).sum()
-                            .unstack(level=0).reindex(np.arange(-self._pos_tmax, 0)).stack(dropna=False)
-                            .swaplevel(0, 1).sort_index().unstack())
+        # sum each month for the given ids, ids without data are left as zeros
+        _, pos_cash_tensor = monthly_tensor(pos_cash, sk_ids, self._pos_tmax, dummies=dummies)
 
         logging.debug('Done')
-        return pos_cash_summary.fillna(0).values
+        return flatten_feature_major(pos_cash_tensor)
 
     def pos_cash_summary(self):
         # read pos cash csv and full list of id values
-        pos_cash = pd.read_csv('data/POS_CASH_balance.csv')
-        bureau = pd.read_csv('data/bureau.csv')
-        id_xref = bureau[['SK_ID_CURR', 'SK_ID_BUREAU']]
-        pos_cash = pos_cash.merge(id_xref).drop(['SK_ID_BUREAU', 'SK_ID_PREV'], axis=1)
+        pos_cash = self._side_table('POS_CASH_balance')
+        id_xref = self._side_table('bureau', projection='id_xref')
+        pos_cash = pos_cash.merge(id_xref)
 
-        # merge bureau ids with application ids
-        pos_cash = self._cat_data_dummies(pos_cash)
+        # one-hot encode categorical columns
+        pos_cash, dummies, dummy_columns = self._one_hot(pos_cash, 'POS_CASH_balance',
+                                                         drop=['SK_ID_BUREAU', 'MONTHS_BALANCE'])
 
         agg_cols = ['CNT_INSTALMENT', 'CNT_INSTALMENT_FUTURE']
-        pos_cash_agg = pos_cash[[*agg_cols, 'SK_ID_CURR']].groupby('SK_ID_CURR').agg(['min', 'max', 'mean'])
-        pos_cash_agg.columns = ['_'.join(a) for a in itertools.product(*pos_cash_agg.columns.levels)]
-
-        pos_cash_sum = pos_cash.drop('MONTHS_BALANCE', axis=1).groupby('SK_ID_CURR').agg(['sum'])
-        pos_cash_sum.columns = ['_'.join(a) for a in itertools.product(*pos_cash_sum.columns.levels)]
-
-        pos_cash_summary = pos_cash_agg.join(pos_cash_sum)
+        pos_cash_summary = group_aggregate(pos_cash, [(agg_cols, ['min', 'max', 'mean']), (None, ['sum'])],
+                                           dummies=dummies, dummy_columns=dummy_columns)
         return pos_cash_summary
 
     def read_installments(self, sk_ids=None):
         logging.debug('Preparing installment plan data...')
-        installments = pd.read_csv('data/installments_payments.csv')
-
         # select all training data if no specific index is given
         if sk_ids is None:
             app_ix = self.get_index()
             sk_ids = app_ix.values
-        installments = installments[installments['SK_ID_CURR'].isin(sk_ids)]
+        installments = self._side_table('installments_payments', sk_ids, projection='sequence')
 
         # filter out data past given time window
         installments = installments[installments['DAYS_INSTALMENT'] > -30. * self._install_mos_max]
 
-        # fill missing id values with na data
-        missing_ids = sk_ids[~np.isin(sk_ids, installments['SK_ID_CURR'].unique())]
+        # fill missing id values with na data, only the rows of sk_ids are scanned
+        missing_ids = sk_ids[~np.isin(sk_ids, installments['SK_ID_CURR'].values)]
         missing_df = pd.DataFrame({'SK_ID_CURR': missing_ids})
         missing_df['DAYS_INSTALMENT'] = -1
-        installments = installments.append(missing_df)
+        installments = pd.concat([installments, missing_df])
+
+        # the 30 day periods start at the earliest installment read, the first read fixes them so inputs of
+        # fewer applicants, e.g. a chunk of new applications, are binned into the same periods
+        if self._install_days is None:
+            self._install_days = (installments['DAYS_INSTALMENT'].min(), installments['DAYS_INSTALMENT'].max())
+        else:
+            first, last = self._install_days
+            installments = installments[installments['DAYS_INSTALMENT'].between(first, last)]
+            anchors = pd.DataFrame({'SK_ID_CURR': sk_ids[0], 'DAYS_INSTALMENT': [first, last]})
+            installments = pd.concat([installments, anchors])
 
         # convert to timedelta index
         installments['DAYS_INSTALMENT'] = pd.to_timedelta(installments['DAYS_INSTALMENT'], unit='D')
@@ -506,17 +770,132 @@ class HCDRDataLoader(DataLoader):
                        .groupby([pd.Grouper(freq='30D'), 'SK_ID_CURR']).sum()
                        .swaplevel(0, 1).sort_index().unstack().fillna(0))
 
+        # periods without any installment of the applicants read get zero columns as well
+        first, last = pd.to_timedelta(self._install_days, unit='D')
+        periods = pd.timedelta_range(start=first, end=last, freq='30D')
+        install_sum = install_sum.reindex(columns=pd.MultiIndex.from_product([['AMT_INSTALMENT', 'AMT_PAYMENT'],
+                                                                              periods]), fill_value=0)
+
         logging.debug('Done')
         return install_sum.values
 
     def installments_summary(self):
         # read installment payments csv
-        installments = pd.read_csv('data/installments_payments.csv')
+        installments = self._side_table('installments_payments')
 
         # calculate aggregate statistics by id
-        installments_agg = (installments
-                            .drop(['SK_ID_PREV'], axis=1)
-                            .groupby('SK_ID_CURR')
-                            .agg(['min', 'max', 'mean', 'sum']))
-        installments_agg.columns = ['_'.join(a) for a in itertools.product(*installments_agg.columns.levels)]
+        installments_agg = group_aggregate(installments, [(None, ['min', 'max', 'mean', 'sum'])])
         return installments_agg
+
+
+class HCDRInferenceLoader(HCDRDataLoader):
+    """
+    Loader restored from the state saved by HCDRDataLoader.save_state. New applications are transformed
+    with the saved transformers, column layouts and summary tables, so nothing is read from or fit on
+    the training data. Time series inputs are built from the side tables for the requested ids only.
+    """
+    def __init__(self, state_dir, data_dir='data', index_side_tables=False):
+        """
+        :param state_dir: directory written by HCDRDataLoader.save_state
+        :param index_side_tables: load the side table indexes up front, see index_side_tables
+        """
+        DataLoader.__init__(self)
+        logging.debug('Restoring data loader from {}'.format(state_dir))
+
+        with open(os.path.join(state_dir, LOADER_STATE_FILE), 'rb') as f:
+            state = pickle.load(f)
+        for name, value in state['attributes'].items():
+            setattr(self, name, value)
+
+        # summary tables stay memory-mapped
+        store = TensorStore(state_dir)
+        for name in self._state_tables:
+            stored_name = name.lstrip('_')
+            index = pd.Index(store.load_ids(stored_name), name='SK_ID_CURR')
+            setattr(self, name, pd.DataFrame(store.load(stored_name), index=index, columns=state['columns'][name]))
+
+        self._data_dir = data_dir
+        self._tables = get_table_store(data_dir)
+        self._tensor_store = None
+        self._assembler = None
+        self._input_shape = None
+        self._test_index = None
+        if index_side_tables:
+            self.index_side_tables()
+
+    def index_side_tables(self):
+        """
+        Load the indexes of the side tables the time series are built from, so the first request of a
+        service does not wait for them
+        """
+        for name, projection in [('credit_card_balance', None), ('bureau_balance', None), ('bureau', 'id_xref'),
+                                 ('POS_CASH_balance', None), ('installments_payments', 'sequence')]:
+            self._tables.index(name, projection=projection)
+        logging.debug('Loaded side table indexes')
+
+    def get_index(self):
+        raise NotImplementedError('The inference loader has no training data')
+
+    def get_test_index(self):
+        if self._test_index is None:
+            self._test_index = pd.Index(self._tables.read('application_test')['SK_ID_CURR'].values, name='SK_ID_CURR')
+        return self._test_index
+
+    def load_train_data(self, split_index=None, fit_transform=True, load_time_series=None):
+        raise NotImplementedError('The inference loader has no training data')
+
+    def load_test_data(self, load_time_series=True):
+        applications = self._tables.read('application_test')
+        self._test_index = pd.Index(applications['SK_ID_CURR'].values, name='SK_ID_CURR')
+        return self.transform_applications(applications, load_time_series)
+
+    def transform_applications(self, applications, load_time_series=None):
+        """
+        Model inputs of raw applications in the layout of application_test.csv
+
+        :param applications: DataFrame of applications with an SK_ID_CURR column or index
+        :param load_time_series: also build the time series inputs, by default as the saved loader did
+        :return: the meta data, or a list of the meta data and the time series inputs
+        """
+        if load_time_series is None:
+            load_time_series = self._load_time_series
+        if 'SK_ID_CURR' in applications.columns:
+            applications = applications.set_index('SK_ID_CURR')
+
+        applications = (applications
+                        .join(self._home_stat_features(applications))
+                        .drop(self._home_stat_cols, axis=1, errors='ignore'))
+        applications = self._clean_applications(applications, fit_transform=False)
+        return self._application_inputs(applications, load_time_series)
+
+    def select_time_series(self, sk_ids):
+        sorted_ids, sorted_rows = np.unique(sk_ids, return_inverse=True)
+        installments = self.read_installments(sorted_ids).astype(np.float32)
+        if self._install_width is not None:
+            installments = self._recent_installments(installments, self._install_width)
+        return [self.read_credit_card_balance(sorted_ids)[sorted_rows],
+                self.read_bureau_balance(sorted_ids)[sorted_rows],
+                self.read_pos_cash(sorted_ids)[sorted_rows],
+                installments[sorted_rows]]
+
+    @staticmethod
+    def _recent_installments(installments, width):
+        # the number of 30 day periods depends on the applicants read, keep the most recent periods of
+        # installment and payment amounts and pad older ones with zeros to the width the models saw
+        periods, new_periods = width // 2, installments.shape[1] // 2
+        kept = min(periods, new_periods)
+        resized = np.zeros((installments.shape[0], width), dtype=installments.dtype)
+        for k in range(2):
+            resized[:, (k + 1) * periods - kept:(k + 1) * periods] = \
+                installments[:, (k + 1) * new_periods - kept:(k + 1) * new_periods]
+        return resized
+
+    def _home_stat_features(self, applications):
+        # applicants seen when the loader was fit keep their features, new ones are projected
+        features = self._home_stats.reindex(applications.index)
+        new_rows = ~applications.index.isin(self._home_stats.index)
+        if new_rows.any():
+            stat = self._encoders['home_stats'].transform_frame(applications.loc[new_rows, self._home_stat_cols])
+            stat = stat.values.astype(np.float64)
+            features.loc[new_rows] = self._st_pca.transform(self._curr_home_imputer.transform(stat))
+        return features
@@ -0,0 +1,84 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+
+class ResultsStore:
+    """
+    Append-only json lines file of model results, one record per (model class, hyperparameter hash,
+    fold). Every record is flushed to disk as soon as it is added, so an interrupted run loses at most
+    the job it was running and a restarted run can skip everything already recorded.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._records = {}
+        self._partial_line = False
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line_number, line in enumerate(f):
+                    self._partial_line = not line.endswith('\n')
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a run killed while writing leaves a partial last line
+                        logging.debug('Skipping unreadable line {} of {}'.format(line_number + 1, path))
+                        continue
+                    self._records[self._record_key(record)] = record
+            logging.debug('Loaded {} results from {}'.format(len(self._records), path))
+
+    def __contains__(self, key):
+        return tuple(key) in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    @staticmethod
+    def params_hash(params):
+        """
+        Short stable hash of a dict of hyperparameters and run settings
+        """
+        params_json = json.dumps(params, sort_keys=True, default=_to_json)
+        return hashlib.sha1(params_json.encode('utf-8')).hexdigest()[:16]
+
+    def append(self, record):
+        """
+        Add a record with at least model, params_hash and fold keys and write it to the end of the file
+        """
+        os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+        with open(self._path, 'a') as f:
+            # start a new line after a partial line left by an interrupted run
+            if self._partial_line:
+                f.write('\n')
+                self._partial_line = False
+            f.write(json.dumps(record, default=_to_json) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._records[self._record_key(record)] = record
+
+    def get(self, model, params_hash, fold):
+        return self._records.get((model, params_hash, fold))
+
+    def records(self, model, params_hash):
+        """
+        Records of all folds of one model and set of hyperparameters, in fold order
+        """
+        return [record for key, record in sorted(self._records.items(), key=lambda item: item[0][2])
+                if key[:2] == (model, params_hash)]
+
+    @staticmethod
+    def _record_key(record):
+        return record['model'], record['params_hash'], record['fold']
+
+
+def _to_json(value):
+    # numpy values in parameters, metrics and keras histories
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{} is not json serializable'.format(type(value)))
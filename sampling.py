@@ -0,0 +1,26 @@
+import numpy as np
+from sklearn.utils.class_weight import compute_sample_weight
+
+
+def oversampled_index(target, random_state=None):
+    """
+    Row index that oversamples every minority class with replacement up to the size of the majority
+    class, the same rows RandomOverSampler would return but without copying any data.
+
+    :param target: class label of each row
+    :return: array of row numbers, every original row followed by the extra minority rows
+    """
+    target = np.asarray(target)
+    rs = np.random.RandomState(random_state)
+    classes, counts = np.unique(target, return_counts=True)
+
+    extra_rows = [rs.choice(np.flatnonzero(target == cls), counts.max() - count, replace=True)
+                  for cls, count in zip(classes, counts) if count < counts.max()]
+    return np.concatenate([np.arange(len(target)), *extra_rows])
+
+
+def balanced_sample_weight(target):
+    """
+    Sample weights that give every class the same total weight, the weighted equivalent of oversampling
+    """
+    return compute_sample_weight('balanced', np.asarray(target))
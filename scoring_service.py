@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import logging
+import argparse
+import functools
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from urllib.request import urlopen, Request
+import numpy as np
+import pandas as pd
+from prepare_data import HCDRInferenceLoader
+from stacking import Ensemble
+from table_index import TableIndex
+from table_store import get_table_store
+
+
+class ApplicantScorer:
+    """
+    Score one applicant at a time with an ensemble saved by fit.ensemble_fit_predict. The loader state,
+    models and applicant indexes of the application and side tables are loaded once, and the model inputs
+    of recently scored applicants are kept in an LRU cache.
+    """
+    def __init__(self, save_dir, data_dir='data', cache_size=4096, application_table='application_test'):
+        """
+        :param save_dir: directory of the saved ensemble
+        :param data_dir: directory of the application and side table csv files
+        :param cache_size: number of applicants whose model inputs are cached
+        :param application_table: table the applications scored by id are looked up in
+        """
+        self._ensemble = Ensemble.load(save_dir)
+        self._time_series = self._ensemble.needs_time_series()
+        self._loader = HCDRInferenceLoader(os.path.join(save_dir, 'loader'), data_dir=data_dir,
+                                           index_side_tables=self._time_series)
+        applications = get_table_store(data_dir).read(application_table)
+        self._applications = TableIndex(applications)
+        self._application_columns = applications.columns
+        self._numeric_columns = applications.select_dtypes(include=[np.number]).columns
+
+        # lru cache of each instance, keyed by id or by the json of a payload
+        self._id_inputs = functools.lru_cache(maxsize=cache_size)(self._assemble_id)
+        self._payload_inputs = functools.lru_cache(maxsize=cache_size)(self._assemble_payload)
+
+        # keras models and the loader are not safe to use from several request threads at once
+        self._lock = threading.Lock()
+
+    def score_id(self, sk_id):
+        """
+        Blended probability of default of an applicant in the application table
+
+        :raises KeyError: if the id is not in the application table
+        """
+        with self._lock:
+            return float(self._ensemble.predict(self._id_inputs(int(sk_id)))[0])
+
+    def score_application(self, application):
+        """
+        Blended probability of default of an application given as a dict of application_test.csv columns,
+        its SK_ID_CURR selects the applicant's rows of the side tables
+        """
+        payload = json.dumps(application, sort_keys=True)
+        with self._lock:
+            return float(self._ensemble.predict(self._payload_inputs(payload))[0])
+
+    def application_ids(self):
+        return self._applications.ids()
+
+    def cache_info(self):
+        return {'id': self._id_inputs.cache_info()._asdict(), 'payload': self._payload_inputs.cache_info()._asdict()}
+
+    def cache_clear(self):
+        self._id_inputs.cache_clear()
+        self._payload_inputs.cache_clear()
+
+    def _assemble_id(self, sk_id):
+        application = self._applications.rows([sk_id])
+        if len(application) == 0:
+            raise KeyError('Unknown SK_ID_CURR {}'.format(sk_id))
+        return self._assemble(application)
+
+    def _assemble_payload(self, payload):
+        application = pd.DataFrame([json.loads(payload)]).reindex(columns=self._application_columns)
+        # json nulls leave numeric columns as objects, which would be taken for categories
+        for col in self._numeric_columns:
+            application[col] = pd.to_numeric(application[col])
+        return self._assemble(application)
+
+    def _assemble(self, application):
+        data = self._loader.transform_applications(application, load_time_series=self._time_series)
+        return data if isinstance(data, list) else [data]
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /score?sk_id_curr=<id> scores an applicant of the application table, POST /score with a json
+    application scores the payload, GET /health reports the cache state. Responses are json.
+    """
+    scorer = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self._respond(200, {'status': 'ok', 'cache': self.scorer.cache_info()})
+        elif url.path == '/score':
+            sk_ids = parse_qs(url.query).get('sk_id_curr')
+            if not sk_ids:
+                self._respond(400, {'error': 'sk_id_curr is required'})
+                return
+            try:
+                self._respond(200, {'SK_ID_CURR': int(sk_ids[0]), 'TARGET': self.scorer.score_id(sk_ids[0])})
+            except KeyError as e:
+                self._respond(404, {'error': str(e.args[0])})
+            except ValueError as e:
+                self._respond(400, {'error': str(e)})
+        else:
+            self._respond(404, {'error': 'Unknown path {}'.format(url.path)})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/score':
+            self._respond(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            application = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._respond(200, {'SK_ID_CURR': application.get('SK_ID_CURR'),
+                                'TARGET': self.scorer.score_application(application)})
+        except (ValueError, KeyError, TypeError) as e:
+            self._respond(400, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        logging.debug('{} - {}'.format(self.address_string(), format % args))
+
+    def _respond(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def make_server(scorer, host='127.0.0.1', port=8000):
+    """
+    HTTP server answering score requests with the given scorer, port 0 picks a free port
+    """
+    handler = type('Handler', (ScoringRequestHandler,), {'scorer': scorer})
+    return HTTPServer((host, port), handler)
+
+
+def latency_benchmark(scorer, sk_ids, repeats=2, http=True):
+    """
+    Latency of scoring each id, first with the model inputs assembled (cold) after the LRU cache is
+    cleared and then read from the cache (warm), through a local HTTP server or by calling the scorer directly.
+
+    :param sk_ids: ids of the application table, the cache should be larger than their number
+    :param repeats: number of warm passes over the ids
+    :return: DataFrame of p50, p99 and mean latency in milliseconds for cold and warm requests
+    """
+    server = None
+    if http:
+        server = make_server(scorer, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}/score?sk_id_curr={{}}'.format(server.server_address[1])
+
+        def score(sk_id):
+            with urlopen(Request(url.format(sk_id))) as response:
+                return json.loads(response.read())['TARGET']
+    else:
+        score = scorer.score_id
+
+    # ids scored before would otherwise be read from the cache in the cold pass
+    scorer.cache_clear()
+    latencies = {'cold': [], 'warm': []}
+    try:
+        for run in ['cold'] + ['warm'] * repeats:
+            for sk_id in sk_ids:
+                start = time.perf_counter()
+                score(sk_id)
+                latencies[run].append((time.perf_counter() - start) * 1000)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    return pd.DataFrame({run: {'p50_ms': np.percentile(times, 50), 'p99_ms': np.percentile(times, 99),
+                               'mean_ms': np.mean(times), 'requests': len(times)}
+                         for run, times in latencies.items()}).T
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Serve or benchmark single applicant scores')
+    parser.add_argument('save_dir', help='directory of an ensemble saved by ensemble_fit_predict')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-size', type=int, default=4096)
+    parser.add_argument('--benchmark', type=int, default=0, help='benchmark this many applicants and exit')
+    args = parser.parse_args()
+
+    applicant_scorer = ApplicantScorer(args.save_dir, data_dir=args.data_dir, cache_size=args.cache_size)
+    if args.benchmark:
+        print(latency_benchmark(applicant_scorer, applicant_scorer.application_ids()[:args.benchmark]))
+    else:
+        logging.debug('Serving scores on port {}'.format(args.port))
+        make_server(applicant_scorer, port=args.port).serve_forever()
@@ -0,0 +1,75 @@
+import math
+import logging
+import numpy as np
+
+
+class GridStrategy:
+    """
+    Run every experiment on every fold, the full cartesian product of the hyperparameter file
+    """
+    def search(self, experiments, folds, evaluate):
+        """
+        :param experiments: list of hyperparameter dicts
+        :param folds: number of folds
+        :param evaluate: function taking a list of (experiment number, hyperparameters) candidates and a
+        list of folds, which runs them and returns the mean validation auc of each candidate
+        """
+        evaluate(list(enumerate(experiments)), list(range(folds)))
+
+
+class SuccessiveHalving:
+    """
+    Successive halving over a training resource such as epochs of the keras models or n_estimators of
+    the boosting models.
+
+    Experiments first run on one fold with their resource cut to a fraction of its value, then only the
+    best 1 / eta of them by validation auc move on to a rung with eta times more resource. The last rung
+    runs the surviving experiments with their full resource on every fold.
+    """
+    def __init__(self, resource='epochs', eta=3, min_resource=1, max_rungs=None):
+        """
+        :param resource: hyperparameter that sets the amount of training, it must be in the hp file
+        :param eta: factor of experiments dropped and resource added at each rung
+        :param min_resource: smallest resource to train any experiment with
+        :param max_rungs: optional limit on the number of rungs
+        """
+        self._resource = resource
+        self._eta = eta
+        self._min_resource = min_resource
+        self._max_rungs = max_rungs
+
+    def search(self, experiments, folds, evaluate):
+        missing = [experiment for experiment in experiments if self._resource not in experiment]
+        if missing:
+            raise ValueError('Successive halving needs {} in every experiment'.format(self._resource))
+
+        # halve until one experiment is left, but not below the smallest resource
+        max_resource = max(experiment[self._resource] for experiment in experiments)
+        num_rungs = 1 + min(self._log_eta(len(experiments)), self._log_eta(max_resource / self._min_resource))
+        if self._max_rungs is not None:
+            num_rungs = min(num_rungs, self._max_rungs)
+
+        survivors = list(range(len(experiments)))
+        for rung in range(num_rungs):
+            last_rung = rung == num_rungs - 1
+            fraction = self._eta ** (rung - num_rungs + 1)
+            candidates = [(i, self._with_resource(experiments[i], fraction)) for i in survivors]
+            logging.debug('Successive halving rung {} of {}: {} experiments at {:.0%} of {}'.format(
+                rung + 1, num_rungs, len(candidates), fraction, self._resource))
+
+            scores = evaluate(candidates, list(range(folds)) if last_rung else [0])
+            if last_rung:
+                break
+
+            # experiments without a score, e.g. after the time budget ran out, rank last
+            scores = np.nan_to_num(np.asarray(scores, dtype=float), nan=-np.inf)
+            keep = max(1, int(math.ceil(len(survivors) / self._eta)))
+            survivors = [survivors[k] for k in np.argsort(-scores, kind='stable')[:keep]]
+
+    def _log_eta(self, value):
+        # number of times value can be divided by eta
+        return int(math.floor(math.log(max(value, 1), self._eta) + 1e-9))
+
+    def _with_resource(self, experiment, fraction):
+        resource = max(self._min_resource, int(round(experiment[self._resource] * fraction)))
+        return {**experiment, self._resource: resource}
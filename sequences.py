@@ -0,0 +1,102 @@
+import numpy as np
+from tensorflow.keras.utils import Sequence
+from tensor_store import read_rows
+from sampling import oversampled_index
+
+
+class MultiInputSequence(Sequence):
+    """
+    Keras input pipeline that reads [meta, sequence_1, ..., sequence_n] inputs one batch at a time.
+
+    Inputs can be numpy arrays, memmaps, RowViews or scipy sparse matrices. Sparse rows are densified
+    per batch, and flat sequence inputs of shape (n, features * sequence_length) in the loader's
+    feature-major layout are reshaped per batch to (batch, sequence_length, features), so the model
+    takes native 3d sequences.
+
+    Given the real length of every row's sequences, rows can be grouped into buckets of similar length
+    and each batch is then only padded to the longest sequence among its rows.
+
+    With balanced, minority class rows are drawn again with replacement every epoch until all classes
+    are the same size, the same effect as random oversampling without copying the inputs.
+    """
+    def __init__(self, inputs, input_shapes, target=None, num_outputs=1, batch_size=256, shuffle=False,
+                 lengths=None, num_buckets=0, balanced=False):
+        """
+        :param inputs: list of input arrays, meta data first
+        :param input_shapes: list of input shapes as given by the data loader
+        :param target: optional target values, repeated for each of the model's outputs
+        :param num_outputs: number of model outputs the target is fed to
+        :param shuffle: reshuffle rows at the end of every epoch
+        :param lengths: optional (n_rows, n_sequence_inputs) array of real sequence lengths
+        :param num_buckets: number of length buckets, zero to pad every batch to the full window
+        :param balanced: oversample minority classes of target in every epoch
+        """
+        self._inputs = inputs
+        self._input_shapes = [tuple(shape) for shape in input_shapes]
+        self._target = None if target is None else np.asarray(target, dtype=np.float32)
+        self._num_outputs = num_outputs
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._lengths = lengths
+        self._num_buckets = num_buckets if lengths is not None else 0
+        self._balanced = balanced and target is not None
+
+        self._batches = self._make_batches()
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __getitem__(self, index):
+        rows = self._batches[index]
+        batch = tuple(self._read_input(data, shape, rows) for data, shape in zip(self._inputs, self._input_shapes))
+
+        # only keep the most recent time steps that any row of the batch has data for
+        if self._num_buckets > 0:
+            max_lengths = np.maximum(self._lengths[rows].max(axis=0), 1)
+            batch = (batch[0], *[values[:, -length:, :] for values, length in zip(batch[1:], max_lengths)])
+
+        if self._target is None:
+            return (batch,)
+        if self._num_outputs == 1:
+            return batch, self._target[rows]
+        return batch, (self._target[rows],) * self._num_outputs
+
+    def on_epoch_end(self):
+        if self._shuffle or self._balanced:
+            self._batches = self._make_batches()
+
+    def row_order(self):
+        """
+        Rows in the order they are fed to the model, to put predictions back in input order
+        """
+        return np.concatenate(self._batches)
+
+    def _make_batches(self):
+        if self._balanced:
+            rows = oversampled_index(self._target)
+        else:
+            rows = np.arange(self._inputs[0].shape[0])
+        if self._shuffle:
+            np.random.shuffle(rows)
+
+        if self._num_buckets == 0:
+            return [rows[start:start + self._batch_size] for start in range(0, len(rows), self._batch_size)]
+
+        # sort rows by their longest sequence and split them into buckets of equal size
+        longest = self._lengths[rows].max(axis=1)
+        buckets = np.array_split(rows[np.argsort(longest, kind='stable')], self._num_buckets)
+        batches = [bucket[start:start + self._batch_size]
+                   for bucket in buckets for start in range(0, len(bucket), self._batch_size)]
+        if self._shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    @staticmethod
+    def _read_input(data, shape, rows):
+        values = read_rows(data, rows).astype(np.float32, copy=False)
+
+        # unpack flat feature-major sequences to (batch, sequence_length, features)
+        if len(shape) == 2 and values.ndim == 2:
+            values = values.reshape(len(rows), shape[1], shape[0]).transpose(0, 2, 1)
+
+        return values
@@ -102,6 +102,24 @@ class SoftImpute:
         else:
             return X_imp
 
+    def transform(self, X):
+        """
+        Low rank reconstruction of rows not seen in fit from their observed values, keeping the fitted
+        column factors. Rows with the same na pattern are solved together.
+        """
+        vd = self.v * self.d.T
+        X_imp = np.zeros(X.shape)
+        observed = ~np.isnan(X)
+        patterns, inverse = np.unique(observed, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for k, pattern in enumerate(patterns):
+            rows = inverse == k
+            if not pattern.any():
+                continue
+            u = np.linalg.lstsq(vd[pattern], X[rows][:, pattern].T, rcond=None)[0]
+            X_imp[rows] = u.T.dot(vd.T)
+        return X_imp
+
 def main():
     X = np.random.random((10,3)) + (np.arange(10).reshape(10,1) ** 2)
 
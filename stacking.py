@@ -0,0 +1,384 @@
+import os
+import logging
+import pickle
+import shutil
+import tempfile
+import functools
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import KFold
+from sklearn.metrics import roc_auc_score
+from feature_bins import FeatureBinner, binned_features
+from results_store import ResultsStore
+from tensor_store import TensorStore
+from job_scheduler import Job, run_jobs
+
+FITTED_MODEL_FILE = 'fitted_model.pkl'
+
+
+class BaseModel:
+    """
+    Base model of the stacked ensemble: a model class from models.py, its arguments and the inputs it
+    takes. The name is only a label, predictions are cached by the configuration.
+    """
+    def __init__(self, name, model_class, model_args=None, meta_only=True, binned=False, balance_classes=True,
+                 threads=1, memory_mb=None):
+        """
+        :param name: column name of the model's predictions
+        :param model_class: model class taking the input shape as first argument
+        :param model_args: keyword arguments of the model class
+        :param meta_only: train on the meta data only instead of the meta data and the time series
+        :param binned: train on the binned meta data shared by the tree models
+        :param balance_classes: weight classes equally when fitting
+        :param threads: threads the model can use when base models are trained concurrently
+        :param memory_mb: estimated peak memory of fitting the model, to schedule concurrent training
+        """
+        self.name = name
+        self.model_class = model_class
+        self.model_args = model_args or {}
+        self.meta_only = meta_only
+        self.binned = binned
+        self.balance_classes = balance_classes
+        self.threads = threads
+        self.memory_mb = memory_mb
+
+    def config(self):
+        return {
+            'model': self.model_class.__name__,
+            'model_args': self.model_args,
+            'meta_only': self.meta_only,
+            'binned': self.binned,
+            'balance_classes': self.balance_classes
+        }
+
+    def fit_predict(self, input_shape, data_train, target_train, data_val, binned=None, model_dir=None):
+        """
+        Fit on the training data and return predictions for the validation data
+
+        :param binned: optional (train, validation) binned meta data, binned here when needed and not given
+        :param model_dir: optional directory to save the fitted model to, for FittedModel.load
+        """
+        model_input_shape = input_shape[0][0] if self.meta_only else input_shape
+        model_train, model_val = (data_train[0], data_val[0]) if self.meta_only else (data_train, data_val)
+        if self.binned:
+            model_train, model_val = binned if binned is not None else binned_features(model_train, model_val)
+
+        logging.debug('Training base model {}'.format(self.name))
+        model = self.model_class(model_input_shape, **self.model_args)
+        model.fit(model_train, target_train, balance_classes=self.balance_classes)
+
+        if model_dir is not None:
+            # the bins are fit again from the same rows and seed as the binned features the model saw
+            binner = FeatureBinner().fit(data_train[0]) if self.binned else None
+            FittedModel(self, model, input_shape, binner).save(model_dir)
+
+        return np.asarray(model.predict(model_val)).squeeze()
+
+
+class FittedModel:
+    """
+    Base model fit on all training applicants with what it needs to predict new ones: the input shapes
+    it was built with and, for binned models, the fitted bins of the meta data
+    """
+    def __init__(self, base_model, model, input_shape, binner=None):
+        self.base_model = base_model
+        self._model = model
+        self._input_shape = input_shape
+        self._binner = binner
+
+    def predict(self, data):
+        """
+        :param data: list of inputs in the layout of the loader, meta data first
+        """
+        if self.base_model.meta_only:
+            data = data[0]
+            if self._binner is not None:
+                data = self._binner.transform(data)
+        return np.asarray(self._model.predict(data)).reshape(-1)
+
+    def save(self, model_dir):
+        # written next to the final directory and moved in place, so a partly saved model is never loaded
+        tmp_dir = '{}.{}.tmp'.format(model_dir.rstrip(os.sep), os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        self._model.save(tmp_dir)
+        with open(os.path.join(tmp_dir, FITTED_MODEL_FILE), 'wb') as f:
+            pickle.dump({'base_model': self.base_model, 'input_shape': self._input_shape, 'binner': self._binner}, f)
+        if os.path.exists(model_dir):
+            shutil.rmtree(model_dir)
+        os.replace(tmp_dir, model_dir)
+
+    @staticmethod
+    def load(model_dir):
+        with open(os.path.join(model_dir, FITTED_MODEL_FILE), 'rb') as f:
+            state = pickle.load(f)
+        base_model, input_shape = state['base_model'], state['input_shape']
+        model = base_model.model_class(input_shape[0][0] if base_model.meta_only else input_shape,
+                                       **base_model.model_args)
+        return FittedModel(base_model, model.load(model_dir), input_shape, state['binner'])
+
+
+class OOFCache:
+    """
+    Out-of-fold and test predictions of base models, stored in a TensorStore by a hash of the base model
+    configuration, the loader configuration and data, and for out-of-fold predictions the folds and
+    fold seed. Every fold is saved as soon as it is predicted, so an interrupted run resumes at the
+    next fold and a base model is only retrained when its own configuration changes.
+
+    Missing predictions are fit one model at a time in this process, or concurrently in separate
+    processes scheduled by the threads and memory hints of the base models. Concurrent models read
+    their fold's inputs memory-mapped from one temporary copy on disk.
+    """
+    def __init__(self, loader, loader_args=None, cache_dir=os.path.join('data', 'cache', 'oof'),
+                 concurrent=False, max_threads=None, max_memory_mb=None):
+        """
+        :param loader: data loader, its data_key is part of the key when it has one
+        :param loader_args: keyword arguments the loader was created with
+        :param concurrent: train missing base models concurrently in separate processes
+        :param max_threads: threads shared by concurrent models, None for one per cpu
+        :param max_memory_mb: memory shared by concurrent models, None for the physical memory
+        """
+        self._loader = loader
+        self._loader_config = {
+            'loader': type(loader).__name__,
+            'loader_args': loader_args or {},
+            'data_key': loader.data_key() if hasattr(loader, 'data_key') else None
+        }
+        self._cache_dir = cache_dir
+        self._store = TensorStore(cache_dir)
+        self._concurrent = concurrent
+        self._max_threads = max_threads
+        self._max_memory_mb = max_memory_mb
+
+    def oof_key(self, base_model, folds, random_state):
+        return ResultsStore.params_hash({**base_model.config(), **self._loader_config,
+                                         'folds': folds, 'random_state': random_state})
+
+    def test_key(self, base_model):
+        return ResultsStore.params_hash({**base_model.config(), **self._loader_config})
+
+    def model_dir(self, base_model):
+        return os.path.join(self._cache_dir, 'models', self.test_key(base_model))
+
+    def fitted_models(self, base_models):
+        """
+        Base models fit on all training applicants, fitting the ones missing from the cache
+        """
+        self.test(base_models)
+        return [FittedModel.load(self.model_dir(base_model)) for base_model in base_models]
+
+    def out_of_fold(self, base_models, folds=4, random_state=0):
+        """
+        Out-of-fold predictions of every training applicant, fitting only the base models and folds
+        missing from the cache
+
+        :param base_models: list of BaseModel
+        :param folds: number of folds
+        :param random_state: seed of the fold split
+        :return: DataFrame of predictions indexed by applicant id with a column per base model
+        """
+        index = self._loader.get_index()
+        kf = KFold(n_splits=folds, shuffle=True, random_state=random_state)
+        keys = [self.oof_key(base_model, folds, random_state) for base_model in base_models]
+        names = [[self._fold_name(key, j) for key in keys] for j in range(folds)]
+
+        splits = []
+        for j, (train_index, val_index) in enumerate(kf.split(index)):
+            missing = [(base_model, name, None) for base_model, name in zip(base_models, names[j])
+                       if name not in self._store]
+            if missing:
+                logging.debug('Fold {}: {} base models to fit'.format(j, len(missing)))
+                splits.append((functools.partial(self._load_fold, train_index, val_index), missing))
+        self._fit_missing(splits)
+
+        predictions = pd.DataFrame(np.nan, index=index, columns=[base_model.name for base_model in base_models])
+        for j, (_, val_index) in enumerate(kf.split(index)):
+            for k, name in enumerate(names[j]):
+                predictions.iloc[val_index, k] = self._store.load(name)
+        return predictions
+
+    def test(self, base_models):
+        """
+        Test predictions of base models fit on all training applicants, fitting only the base models
+        missing from the cache. The fitted models are kept in the cache for fitted_models.
+
+        :return: DataFrame of predictions indexed by test applicant id with a column per base model
+        """
+        names = ['test_{}'.format(self.test_key(base_model)) for base_model in base_models]
+        missing = [(base_model, name, self.model_dir(base_model)) for base_model, name in zip(base_models, names)
+                   if name not in self._store or not os.path.isdir(self.model_dir(base_model))]
+        if missing:
+            self._fit_missing([(self._load_test, missing)])
+
+        predictions = pd.DataFrame(np.nan, index=self._loader.get_test_index(),
+                                   columns=[base_model.name for base_model in base_models])
+        for k, name in enumerate(names):
+            predictions.iloc[:, k] = self._store.load(name)
+        return predictions
+
+    def _fit_missing(self, splits):
+        """
+        Fit the missing base models of every split and save their predictions to the cache
+
+        :param splits: list of (load, missing) pairs, load a function of load_time_series returning train
+        data, train target and the data to predict, missing a list of (base model, cache name, directory
+        to save the fitted model to or None)
+        """
+        if not self._concurrent:
+            for load, missing in splits:
+                data_train, target_train, data_val, input_shape = self._load_split(load, missing)
+                for base_model, name, model_dir in missing:
+                    y = base_model.fit_predict(input_shape, data_train, target_train, data_val, model_dir=model_dir)
+                    self._store.save(name, y.reshape(-1))
+            return
+
+        with tempfile.TemporaryDirectory(prefix='stacking_') as split_root:
+            jobs = []
+            for k, (load, missing) in enumerate(splits):
+                data_train, target_train, data_val, input_shape = self._load_split(load, missing)
+                split_dir = os.path.join(split_root, 'split_{}'.format(k))
+                _save_split(TensorStore(split_dir), data_train, target_train, data_val,
+                            any(base_model.binned for base_model, _, _ in missing))
+                del data_train, data_val
+                jobs += [Job(name, _fit_predict_split, (base_model, split_dir, input_shape, model_dir),
+                             threads=base_model.threads, memory_mb=base_model.memory_mb)
+                         for base_model, name, model_dir in missing]
+
+            for name, y in run_jobs(jobs, max_threads=self._max_threads, max_memory_mb=self._max_memory_mb):
+                self._store.save(name, y.reshape(-1))
+
+    def _load_split(self, load, missing):
+        load_time_series = not all(base_model.meta_only for base_model, _, _ in missing)
+        data_train, target_train, data_val = load(load_time_series)
+        return self._as_list(data_train), target_train, self._as_list(data_val), self._input_shape(load_time_series)
+
+    def _load_fold(self, train_index, val_index, load_time_series):
+        data_train, target_train, data_val, _ = self._loader.load_train_val(
+            train_index, val_index, {'load_time_series': load_time_series})
+        return data_train, target_train, data_val
+
+    def _load_test(self, load_time_series):
+        data_train, target_train = self._loader.load_train_data(load_time_series=load_time_series)
+        return data_train, target_train, self._loader.load_test_data(load_time_series=load_time_series)
+
+    def _input_shape(self, load_time_series):
+        input_shape = self._loader.get_input_shape()
+        if not load_time_series:
+            # the loader reports the meta data width alone without time series
+            input_shape = [(input_shape if np.isscalar(input_shape) else input_shape[0],)]
+        return input_shape
+
+    @staticmethod
+    def _fold_name(key, fold):
+        return 'oof_{}_{}'.format(key, fold)
+
+    @staticmethod
+    def _as_list(data):
+        # meta data alone comes back as a single array
+        return data if isinstance(data, list) else [data]
+
+
+def _save_split(store, data_train, target_train, data_val, binned):
+    for split, data in [('train', data_train), ('val', data_val)]:
+        for k, data_part in enumerate(data):
+            store.save('{}_{}'.format(split, k), data_part)
+    store.save('train_target', np.asarray(target_train))
+    if binned:
+        # bin once for all the tree models of the split
+        binned_train, binned_val = binned_features(data_train[0], data_val[0])
+        store.save('train_binned', binned_train, dtype=np.uint8)
+        store.save('val_binned', binned_val, dtype=np.uint8)
+
+
+def _fit_predict_split(base_model, split_dir, input_shape, model_dir=None):
+    # runs in a worker process on the memory-mapped inputs of one split
+    store = TensorStore(split_dir)
+    num_inputs = len(input_shape)
+    data_train = [store.load('train_{}'.format(k)) for k in range(num_inputs)]
+    data_val = [store.load('val_{}'.format(k)) for k in range(num_inputs)]
+    target_train = np.asarray(store.load('train_target')).astype(int)
+    binned = (store.load('train_binned'), store.load('val_binned')) if base_model.binned else None
+    return base_model.fit_predict(input_shape, data_train, target_train, data_val, binned=binned, model_dir=model_dir)
+
+
+class Stacker:
+    """
+    Meta-learner of the stacked ensemble, fit on out-of-fold base model predictions centered on 0.5
+    """
+    def __init__(self, meta_learner=None):
+        """
+        :param meta_learner: classifier with fit and predict_proba, by default a balanced logistic
+        regression without intercept
+        """
+        if meta_learner is None:
+            meta_learner = LogisticRegression(class_weight='balanced', C=0.1, fit_intercept=False)
+        self._meta_learner = meta_learner
+        self._columns = None
+
+    def fit(self, predictions, target):
+        self._columns = list(predictions.columns)
+        self._meta_learner.fit(np.asarray(predictions) - 0.5, np.asarray(target))
+        return self
+
+    def predict(self, predictions):
+        return self._meta_learner.predict_proba(np.asarray(predictions[self._columns]) - 0.5)[:, 1]
+
+    def weights(self):
+        """
+        Weight of each base model, for linear meta-learners
+        """
+        return pd.Series(np.asarray(self._meta_learner.coef_).squeeze(), index=self._columns)
+
+    def cross_validate(self, predictions, target, folds=4, random_state=0):
+        """
+        Validation auc of the meta-learner on each fold of the out-of-fold predictions
+
+        :return: DataFrame with the auc and the weights of each fold
+        """
+        target = np.asarray(target)
+        kf = KFold(n_splits=folds, shuffle=True, random_state=random_state)
+        results = []
+        for train_index, val_index in kf.split(predictions):
+            self.fit(predictions.iloc[train_index], target[train_index])
+            result = {'auc': roc_auc_score(target[val_index], self.predict(predictions.iloc[val_index]))}
+            if hasattr(self._meta_learner, 'coef_'):
+                result.update(self.weights())
+            results.append(result)
+        return pd.DataFrame(results)
+
+
+class Ensemble:
+    """
+    Fitted base models and the meta-learner stacking them, everything needed to score new applicants
+    from the loader's inputs
+    """
+    def __init__(self, fitted_models, stacker):
+        self._fitted_models = fitted_models
+        self._stacker = stacker
+
+    def base_predictions(self, data):
+        return pd.DataFrame({fitted.base_model.name: fitted.predict(data) for fitted in self._fitted_models})
+
+    def predict(self, data):
+        """
+        :param data: list of inputs in the layout of the loader, meta data first, or the meta data alone
+        """
+        return self._stacker.predict(self.base_predictions(data if isinstance(data, list) else [data]))
+
+    def needs_time_series(self):
+        return not all(fitted.base_model.meta_only for fitted in self._fitted_models)
+
+    def save(self, save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+        for fitted in self._fitted_models:
+            fitted.save(os.path.join(save_dir, 'models', fitted.base_model.name))
+        with open(os.path.join(save_dir, 'ensemble.pkl'), 'wb') as f:
+            pickle.dump({'names': [fitted.base_model.name for fitted in self._fitted_models],
+                         'stacker': self._stacker}, f)
+
+    @staticmethod
+    def load(save_dir):
+        with open(os.path.join(save_dir, 'ensemble.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        fitted_models = [FittedModel.load(os.path.join(save_dir, 'models', name)) for name in state['names']]
+        return Ensemble(fitted_models, state['stacker'])
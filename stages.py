@@ -0,0 +1,155 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# stages of the current run_stages call, inherited by forked workers instead of being pickled
+_stages = None
+
+
+def run_stages(stages, workers=1):
+    """
+    Run independent stages, each a function without arguments, and collect their results.
+
+    With more than one worker the stages run in a pool of forked processes, each stage in a fresh
+    process, so the stages and the data they read are inherited rather than pickled and only results
+    are sent back. Wall time and peak memory of every stage are logged. One worker, or a platform
+    without fork, runs the stages one after another in this process, which is easier to debug.
+
+    Forking a process that already runs tensorflow or blas threads can deadlock the children, so only
+    ask for more workers before those libraries start, e.g. not after importing models.
+
+    :param stages: dict of stage name to function
+    :param workers: number of worker processes, None for one per cpu
+    :return: dict of stage name to result
+    """
+    global _stages
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(stages))
+
+    results = {}
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for name in stages:
+            results[name], usage = _run_stage(name, stages)
+            _log_usage(name, usage)
+        return results
+
+    _stages = stages
+    try:
+        with multiprocessing.get_context('fork').Pool(workers, maxtasksperchild=1) as pool:
+            for name, (result, usage) in pool.imap_unordered(_run_named_stage, stages):
+                results[name] = result
+                _log_usage(name, usage)
+    finally:
+        _stages = None
+
+    # keep results in stage order
+    return {name: results[name] for name in stages}
+
+
+def _run_stage(name, stages=None):
+    stages = _stages if stages is None else stages
+    start_rss = current_rss()
+    start_time = time.time()
+    result = stages[name]()
+    usage = {'wall_time': time.time() - start_time, 'peak_rss': peak_rss(), 'start_rss': start_rss,
+             'pid': os.getpid()}
+    return result, usage
+
+
+def _run_named_stage(name):
+    return name, _run_stage(name)
+
+
+def _log_usage(name, usage):
+    logging.debug('Stage {} finished in {:.1f}s, peak memory {:.0f} MB ({:+.0f} MB) in process {}'.format(
+        name, usage['wall_time'], usage['peak_rss'] / 2 ** 20, (usage['peak_rss'] - usage['start_rss']) / 2 ** 20,
+        usage['pid']))
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, read from /proc where available
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes
+    """
+    # the high water mark in /proc starts over in a new process, ru_maxrss keeps the parent's at fork
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    # ru_maxrss is in kilobytes on linux
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemory:
+    """
+    Peak resident set size of this process while a block runs, as a context manager. The high water
+    mark of the process is reset on entry where /proc/self/clear_refs allows it, so earlier peaks of
+    the process don't count. Elsewhere the resident set size is sampled from a thread instead.
+    """
+    def __init__(self, interval=0.05):
+        """
+        :param interval: seconds between samples when the high water mark can't be reset
+        """
+        self._interval = interval
+        self._sampled_peak = 0
+        self._stop = None
+        self._thread = None
+        self.start_rss = None
+        self.peak_rss = None
+
+    def __enter__(self):
+        self.start_rss = current_rss()
+        try:
+            # 5 resets the high water mark of the process to its current size
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            self._sampled_peak = self.start_rss
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is None:
+            self.peak_rss = peak_rss()
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak_rss = max(self._sampled_peak, current_rss())
+        return False
+
+    def growth(self):
+        """
+        Peak resident set size above the size on entry
+        """
+        return max(self.peak_rss - self.start_rss, 0)
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            self._sampled_peak = max(self._sampled_peak, current_rss())
@@ -0,0 +1,217 @@
+import numpy as np
+
+
+class ColumnMoments:
+    """
+    Sufficient statistics of the columns of a block of rows: the number of rows and, per column, the number
+    of values that are not na, their mean and their sum of squared deviations from it.
+
+    Statistics of disjoint blocks add and subtract exactly (up to rounding), so the statistics of a fold are
+    those of all rows minus those of its held-out rows. Means and deviations are kept centered, so columns
+    with a large mean and a small spread keep their precision.
+    """
+    def __init__(self, rows, counts, means, deviations):
+        self._rows = rows
+        self._counts = counts
+        self._means = means
+        self._deviations = deviations
+
+    @classmethod
+    def of(cls, values, chunk_columns=64):
+        """
+        :param values: 2d array with a column per feature, na values are missing
+        :param chunk_columns: number of columns converted to float64 at once
+        """
+        counts = np.empty(values.shape[1], dtype=np.int64)
+        means = np.empty(values.shape[1])
+        deviations = np.empty(values.shape[1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for start in range(0, values.shape[1], chunk_columns):
+                chunk = values[:, start:start + chunk_columns].astype(np.float64)
+                end = start + chunk.shape[1]
+                counts[start:end] = chunk.shape[0] - np.isnan(chunk).sum(axis=0)
+                means[start:end] = np.nansum(chunk, axis=0) / counts[start:end]
+                chunk -= means[start:end]
+                deviations[start:end] = np.nansum(chunk * chunk, axis=0)
+        return cls(values.shape[0], counts, means, deviations)
+
+    def __add__(self, other):
+        counts = self._counts + other._counts
+        delta = np.nan_to_num(other._means) - np.nan_to_num(self._means)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            share = np.where(counts > 0, other._counts / counts, 0)
+        means = np.nan_to_num(self._means) + delta * share
+        means[counts == 0] = np.nan
+        deviations = self._deviations + other._deviations + delta ** 2 * self._counts * share
+        return ColumnMoments(self._rows + other._rows, counts, means, deviations)
+
+    def __sub__(self, other):
+        counts = self._counts - other._counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sums = self._counts * np.nan_to_num(self._means) - other._counts * np.nan_to_num(other._means)
+            means = sums / counts
+            delta = np.nan_to_num(other._means - means)
+            deviations = self._deviations - other._deviations - delta ** 2 * counts * other._counts / self._counts
+        means[counts == 0] = np.nan
+        deviations = np.clip(np.nan_to_num(deviations), 0, None)
+        return ColumnMoments(self._rows - other._rows, counts, means, deviations)
+
+    def rows(self):
+        return self._rows
+
+    def missing(self):
+        """
+        Number of na values of each column
+        """
+        return self._rows - self._counts
+
+    def means(self):
+        """
+        Mean of the values of each column that are not na, na for columns without values
+        """
+        return self._means
+
+    def filled_variances(self):
+        """
+        Variance of each column over all rows once its na values are filled with its mean
+        """
+        return self._deviations / self._rows
+
+    def with_column(self, position, count, mean, deviation):
+        """
+        Copy of the statistics with those of one column replaced
+        """
+        counts, means, deviations = self._counts.copy(), self._means.copy(), self._deviations.copy()
+        counts[position], means[position], deviations[position] = count, mean, deviation
+        return ColumnMoments(self._rows, counts, means, deviations)
+
+
+class CrossProducts:
+    """
+    Sums of the products of every pair of a few columns of a block of rows, with a leading column of ones,
+    kept per pattern of na values of the columns. Na values count as zero in the sums.
+
+    Like ColumnMoments, cross products of disjoint blocks add and subtract, and they are enough to fit a
+    linear regression between the columns, to fill the na values of a column with its predictions and to
+    fit the next regression on the filled column, without another pass over the rows.
+    """
+    def __init__(self, products):
+        """
+        :param products: dict of a tuple of na flags per column to the cross product matrix of those rows
+        """
+        self._products = products
+
+    @classmethod
+    def of(cls, values):
+        """
+        :param values: 2d array with a column per feature, na values are missing
+        """
+        missing = np.isnan(values)
+        design = np.column_stack([np.ones(len(values)), np.where(missing, 0, values)]).astype(np.float64)
+        patterns, inverse = np.unique(missing, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        products = {}
+        for i, pattern in enumerate(patterns):
+            rows = design[inverse == i]
+            products[tuple(pattern)] = rows.T @ rows
+        return cls(products)
+
+    def __add__(self, other):
+        products = dict(self._products)
+        for pattern, product in other._products.items():
+            products[pattern] = products[pattern] + product if pattern in products else product
+        return CrossProducts(products)
+
+    def __sub__(self, other):
+        return self + CrossProducts({pattern: -product for pattern, product in other._products.items()})
+
+    def regression(self, target, features):
+        """
+        Least squares fit of the target column on the feature columns, over the rows where all of them
+        have values
+
+        :param target: position of the target column
+        :param features: positions of the feature columns
+        :return: LinearPredictor
+        """
+        product = self._sum(lambda pattern: not any(pattern[col] for col in [target, *features]))
+        rows = product[0, 0]
+        means = product[0] / rows
+        covariances = product / rows - np.outer(means, means)
+
+        x = [col + 1 for col in features]
+        coef = np.linalg.lstsq(covariances[np.ix_(x, x)], covariances[x, target + 1], rcond=None)[0]
+        return LinearPredictor(coef, means[target + 1] - means[x] @ coef)
+
+    def fill(self, target, features, predictor):
+        """
+        Cross products once the na values of the target column are filled with the predictions of the
+        feature columns, in rows where the features have values
+        """
+        transform = np.eye(len(next(iter(self._products.values()))))
+        transform[target + 1, 0] = predictor.intercept_
+        transform[target + 1, [col + 1 for col in features]] = predictor.coef_
+
+        filled = CrossProducts({})
+        for pattern, product in self._products.items():
+            if pattern[target] and not any(pattern[col] for col in features):
+                product = transform @ product @ transform.T
+                pattern = tuple(False if col == target else flag for col, flag in enumerate(pattern))
+            filled += CrossProducts({pattern: product})
+        return filled
+
+    def moments(self, column):
+        """
+        :return: number of values of the column that are not na, their mean and sum of squared deviations
+        """
+        product = self._sum(lambda pattern: not pattern[column])
+        count, total = product[0, 0], product[0, column + 1]
+        if count == 0:
+            return 0, np.nan, 0.0
+        return count, total / count, max(product[column + 1, column + 1] - total * total / count, 0.0)
+
+    def _sum(self, selected):
+        size = len(next(iter(self._products.values())))
+        return sum((product for pattern, product in self._products.items() if selected(pattern)),
+                   np.zeros((size, size)))
+
+
+class LinearPredictor:
+    """
+    Linear regression fitted from cross products, predicting like sklearn's LinearRegression
+    """
+    def __init__(self, coef, intercept):
+        self.coef_ = coef
+        self.intercept_ = intercept
+
+    def predict(self, x):
+        return np.asarray(x, dtype=np.float64) @ self.coef_ + self.intercept_
+
+
+class MomentScaler:
+    """
+    Standard scaling fitted from ColumnMoments, transforming like sklearn's StandardScaler. Columns with a
+    variance within rounding error of zero are not scaled.
+    """
+    def __init__(self):
+        self.mean_ = None
+        self.scale_ = None
+
+    def fit_moments(self, moments):
+        """
+        :param moments: ColumnMoments of the columns with na values filled by their mean, na columns are zero
+        """
+        means = np.nan_to_num(moments.means())
+        variances = moments.filled_variances()
+        eps = np.finfo(np.float64).eps
+        constant = variances <= moments.rows() * eps * variances + (moments.rows() * means * eps) ** 2
+        self.mean_ = means
+        self.scale_ = np.where(constant, 1.0, np.sqrt(variances))
+        return self
+
+    def transform(self, x, copy=True):
+        if copy:
+            x = x.copy()
+        x -= self.mean_
+        x /= self.scale_
+        return x
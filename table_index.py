@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class TableIndex:
+    """
+    Rows of a table grouped by id: the table is sorted by id once and the offset of each id's first row
+    is kept, so the rows of a few ids are found by binary search instead of a scan of the whole table.
+    Rows of one id keep their order in the table.
+    """
+    def __init__(self, table, id_col='SK_ID_CURR', presorted=False):
+        """
+        :param presorted: the table is already sorted by id, e.g. a copy sorted by the table store
+        """
+        if presorted:
+            self._table = table
+            sorted_ids = table[id_col].values
+        else:
+            ids = table[id_col].values
+            order = np.argsort(ids, kind='stable')
+            sorted_ids = ids[order]
+            self._table = table.iloc[order].reset_index(drop=True)
+
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])[:len(sorted_ids)]
+        self._ids = sorted_ids[starts]
+        self._offsets = np.r_[starts, len(sorted_ids)]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def ids(self):
+        """
+        Ids with rows in the table, in ascending order
+        """
+        return self._ids
+
+    def table(self):
+        """
+        The whole table, sorted by id
+        """
+        return self._table
+
+    def row_numbers(self, sk_ids):
+        """
+        Positions in the sorted table of the rows of the given ids, in the order of sk_ids
+        """
+        sk_ids = np.atleast_1d(sk_ids)
+        positions = np.searchsorted(self._ids, sk_ids)
+        positions[positions == len(self._ids)] = 0
+        found = positions[self._ids[positions] == sk_ids] if len(self._ids) else positions[:0]
+
+        starts, ends = self._offsets[found], self._offsets[found + 1]
+        counts = ends - starts
+        # each id's range of rows, laid end to end
+        return np.repeat(starts - np.r_[0, np.cumsum(counts)[:-1]], counts) + np.arange(counts.sum())
+
+    def rows(self, sk_ids):
+        """
+        Rows of the given ids, ids without rows are skipped
+        """
+        return self._table.iloc[self.row_numbers(sk_ids)]
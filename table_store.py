@@ -0,0 +1,351 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from table_index import TableIndex
+
+try:
+    import pyarrow  # noqa: F401
+    _BINARY_FORMAT = 'feather'
+except ImportError:
+    _BINARY_FORMAT = 'pickle'
+
+
+class TableSchema:
+    """
+    Compact dtypes and column projections for one raw csv table.
+
+    At ingest ids (SK_ID_*) and int_columns are read as int32, columns matching flag_pattern as uint8,
+    remaining numeric columns as float32 and string columns straight into pandas Categorical. Columns
+    in drop are never read, and projections name the column subsets read by individual loader stages.
+    Tables without an SK_ID_CURR column name the (table, projection) that maps their ids to applicants
+    in id_xref.
+    """
+    def __init__(self, int_columns=(), flag_pattern=None, drop=(), projections=None, id_xref=None,
+                 sample_rows=10000):
+        self.int_columns = list(int_columns)
+        self.flag_pattern = flag_pattern
+        self.drop = list(drop)
+        self.projections = projections if projections is not None else {}
+        self.id_xref = id_xref
+        self.sample_rows = sample_rows
+
+    def dtypes(self, sample):
+        """
+        Map each column to its compact dtype, using a sample of the csv to tell strings from numbers
+        """
+        dtypes = {}
+        for col in sample.columns:
+            if col in self.drop:
+                continue
+            if sample[col].dtype == 'object':
+                dtypes[col] = 'category'
+            elif col.startswith('SK_ID_') or col in self.int_columns:
+                dtypes[col] = 'int32'
+            elif self.flag_pattern is not None and re.match(self.flag_pattern, col):
+                dtypes[col] = 'uint8'
+            else:
+                dtypes[col] = 'float32'
+        return dtypes
+
+    def key(self):
+        spec = json.dumps([self.int_columns, self.flag_pattern, self.drop])
+        return hashlib.blake2b(spec.encode(), digest_size=4).hexdigest()
+
+
+# suffix of the copies of tables sorted by applicant
+SORTED_SUFFIX = '-by_id'
+
+# columns every stage of the loader reads from each raw table
+TABLE_SCHEMAS = {
+    'application_train': TableSchema(flag_pattern=r'^(TARGET$|FLAG_|REG_|LIVE_)'),
+    'application_test': TableSchema(flag_pattern=r'^(FLAG_|REG_|LIVE_)'),
+    'bureau': TableSchema(projections={'id_xref': ['SK_ID_CURR', 'SK_ID_BUREAU']}),
+    'bureau_balance': TableSchema(int_columns=['MONTHS_BALANCE'], id_xref=('bureau', 'id_xref')),
+    'previous_application': TableSchema(int_columns=['NFLAG_LAST_APPL_IN_DAY'], drop=['SK_ID_PREV']),
+    'credit_card_balance': TableSchema(int_columns=['MONTHS_BALANCE'], drop=['SK_ID_PREV']),
+    'POS_CASH_balance': TableSchema(int_columns=['MONTHS_BALANCE'], drop=['SK_ID_PREV']),
+    'installments_payments': TableSchema(drop=['SK_ID_PREV'],
+                                         projections={'sequence': ['SK_ID_CURR', 'DAYS_INSTALMENT',
+                                                                   'AMT_INSTALMENT', 'AMT_PAYMENT']}),
+}
+
+
+class TableStore:
+    """
+    Parse each raw csv table once per process and keep it in memory. A binary columnar copy of every
+    parsed table is written next to the data, keyed by the csv's size, mtime and content hash, so later
+    runs load the binary copy instead of parsing the csv again.
+
+    Tables are shared between callers and must be treated as read-only.
+
+    Side tables can also be read through an index by applicant, backed by a second binary copy with the
+    rows sorted by SK_ID_CURR that is written once and, like the first one, read back by later runs.
+    """
+    def __init__(self, data_dir='data', cache_dir=None):
+        self._data_dir = data_dir
+        self._cache_dir = cache_dir if cache_dir is not None else os.path.join(data_dir, 'cache')
+        self._tables = {}
+        self._columns = {}
+        self._indexes = {}
+        self._memory = {}
+
+    def read(self, name, projection=None):
+        """
+        Return the parsed table for data_dir/<name>.csv, optionally only the columns of a named projection
+        from the table's schema. Only columns that have been asked for are kept in memory.
+        """
+        schema = self.schema(name)
+        if name not in self._columns:
+            self._columns[name] = self._load_columns(name)
+
+        if projection is None:
+            columns = self._columns[name]
+        else:
+            columns = schema.projections[projection]
+
+        table = self._tables.get(name)
+        missing = [col for col in columns if table is None or col not in table.columns]
+        if missing:
+            loaded = self._load(name, missing)
+            table = loaded if table is None else pd.concat([table, loaded], axis=1)
+            self._tables[name] = table[[col for col in self._columns[name] if col in table.columns]]
+            table = self._tables[name]
+
+        if len(columns) == len(table.columns):
+            return table
+        return table[columns]
+
+    def index(self, name, projection=None):
+        """
+        Rows of a table grouped by applicant, from the copy of the table sorted by SK_ID_CURR. The rows of
+        any set of applicants are slices of the sorted copy, instead of a scan of the whole table. Tables
+        with an id_xref get the SK_ID_CURR column of their cross reference table.
+
+        :return: TableIndex of the columns of the named projection, or of all columns
+        """
+        key = (name, projection)
+        if key not in self._indexes:
+            table = self.read('{}{}'.format(name, SORTED_SUFFIX), projection=projection)
+            self._indexes[key] = TableIndex(table, presorted=True)
+        return self._indexes[key]
+
+    def read_chunks(self, name, chunk_rows=50000, path=None):
+        """
+        Parse a csv table chunk by chunk with the compact dtypes of its schema, without keeping it in memory
+        or writing a binary copy, for files only read once from start to end.
+
+        :param name: name of the table whose schema is used
+        :param chunk_rows: number of rows of each chunk
+        :param path: csv file to parse, data_dir/<name>.csv by default
+        :return: iterator of DataFrames
+        """
+        schema = self.schema(name)
+        path = path if path is not None else self.csv_path(name)
+
+        dtypes = schema.dtypes(pd.read_csv(path, nrows=schema.sample_rows))
+        logging.debug('Parsing {} in chunks of {} rows'.format(path, chunk_rows))
+        return pd.read_csv(path, usecols=list(dtypes), dtype=dtypes, chunksize=chunk_rows)
+
+    def release(self, name=None):
+        """
+        Drop one (or every) parsed table from memory, the binary copy on disk is kept.
+        """
+        if name is None:
+            self._tables.clear()
+            self._indexes.clear()
+        else:
+            self._tables.pop(name, None)
+            self._tables.pop('{}{}'.format(name, SORTED_SUFFIX), None)
+            self._indexes = {key: index for key, index in self._indexes.items() if key[0] != name}
+
+    @staticmethod
+    def schema(name):
+        if name.endswith(SORTED_SUFFIX):
+            name = name[:-len(SORTED_SUFFIX)]
+        return TABLE_SCHEMAS.get(name, TableSchema())
+
+    def memory_report(self):
+        """
+        Memory used by each table read so far with compact dtypes, against the same table
+        parsed with default int64/float64/object dtypes.
+        """
+        report = pd.DataFrame.from_dict(self._memory, orient='index', columns=['default_bytes', 'compact_bytes'])
+        report['saved_bytes'] = report['default_bytes'] - report['compact_bytes']
+        return report
+
+    def csv_path(self, name):
+        return os.path.join(self._data_dir, '{}.csv'.format(name))
+
+    def fingerprint(self, name):
+        """
+        Fingerprint of a csv file as (size, mtime, content hash). The content hash is only recomputed
+        when the size or mtime differ from the last recorded fingerprint.
+        """
+        path = self.csv_path(name)
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+
+        record_path = os.path.join(self._cache_dir, '{}.fingerprint.json'.format(name))
+        if os.path.exists(record_path):
+            with open(record_path, 'r') as f:
+                record = json.load(f)
+            if record['size'] == size and record['mtime'] == mtime:
+                return size, mtime, record['hash']
+
+        content_hash = self._hash_file(path)
+        os.makedirs(self._cache_dir, exist_ok=True)
+        with open(record_path, 'w') as f:
+            json.dump({'size': size, 'mtime': mtime, 'hash': content_hash}, f)
+        return size, mtime, content_hash
+
+    def _binary_path(self, name):
+        if name.endswith(SORTED_SUFFIX):
+            return self._sorted_binary_path(name[:-len(SORTED_SUFFIX)])
+        size, mtime, content_hash = self.fingerprint(name)
+        return os.path.join(self._cache_dir, '{}-{}-{}.{}'.format(name, content_hash[:16], self.schema(name).key(),
+                                                                  _BINARY_FORMAT))
+
+    def _load_columns(self, name):
+        """
+        Column list of a table, parsing the csv and writing its binary copy if there is none yet
+        """
+        binary_path = self._binary_path(name)
+        if not os.path.exists(binary_path):
+            if name.endswith(SORTED_SUFFIX):
+                self._sort(name[:-len(SORTED_SUFFIX)], binary_path)
+            else:
+                self._parse(name, binary_path)
+        with open('{}.json'.format(binary_path), 'r') as f:
+            return json.load(f)['columns']
+
+    def _load(self, name, columns):
+        binary_path = self._binary_path(name)
+        logging.debug('Loading {} columns of {} from binary copy'.format(len(columns), name))
+        if _BINARY_FORMAT == 'feather':
+            table = pd.read_feather(binary_path, columns=columns)
+        else:
+            table = pd.read_pickle(binary_path)[columns]
+        self._log_memory(name, table)
+        return table
+
+    def _parse(self, name, binary_path):
+        schema = self.schema(name)
+        path = self.csv_path(name)
+
+        logging.debug('Parsing {}...'.format(path))
+        sample = pd.read_csv(path, nrows=schema.sample_rows)
+        dtypes = schema.dtypes(sample)
+        table = pd.read_csv(path, usecols=list(dtypes), dtype=dtypes)
+
+        # drop binary copies of older versions of the same file, and their sorted copies, before writing the new one
+        self._remove_copies('{}-'.format(name), binary_path)
+        self._write(table, binary_path, dtypes)
+
+    def _sorted_binary_path(self, name):
+        # the sorted copy changes with the table and with the table its applicant ids come from
+        sources = [name] + ([self.schema(name).id_xref[0]] if self.schema(name).id_xref else [])
+        key = hashlib.blake2b('|'.join(os.path.basename(self._binary_path(source)) for source in sources).encode(),
+                              digest_size=8).hexdigest()
+        return os.path.join(self._cache_dir, '{}{}-{}.{}'.format(name, SORTED_SUFFIX, key, _BINARY_FORMAT))
+
+    def _sort(self, name, binary_path):
+        schema = self.schema(name)
+        loaded = name in self._tables
+
+        logging.debug('Sorting {} by applicant...'.format(name))
+        table = self.read(name)
+        if schema.id_xref is not None:
+            table = table.merge(self.read(*schema.id_xref))
+        categories = {col: _categories_by_appearance(table[col])
+                      for col in table.select_dtypes(include=['category']).columns}
+        table = table.iloc[np.argsort(table['SK_ID_CURR'].values, kind='stable')].reset_index(drop=True)
+
+        # dummy columns follow the order categories first appear in, which sorting would change, so the
+        # order of the source table is kept as an ordered categorical with na values as 'Unspecified'
+        for col, labels in categories.items():
+            values = table[col]
+            if values.isna().any():
+                values = values.cat.add_categories('Unspecified').fillna('Unspecified')
+            table[col] = values.cat.set_categories(labels, ordered=True)
+        if not loaded:
+            # later reads go through the sorted copy
+            self.release(name)
+
+        self._remove_copies('{}{}-'.format(name, SORTED_SUFFIX), binary_path)
+        self._write(table, binary_path, {col: str(dt) for col, dt in table.dtypes.items()})
+
+    def _remove_copies(self, prefix, binary_path):
+        # stage workers may be writing the same copy at once, only other versions are removed
+        current = os.path.basename(binary_path)
+        for file_name in os.listdir(self._cache_dir):
+            if file_name.startswith(prefix) and not file_name.startswith(current):
+                try:
+                    os.remove(os.path.join(self._cache_dir, file_name))
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _write(table, binary_path, dtypes):
+        # write to temporary files first so concurrent readers never see a partial copy
+        tmp_path = '{}.{}.tmp'.format(binary_path, os.getpid())
+        if _BINARY_FORMAT == 'feather':
+            table.to_feather(tmp_path)
+        else:
+            table.to_pickle(tmp_path)
+        with open('{}.json'.format(tmp_path), 'w') as f:
+            json.dump({'columns': list(table.columns), 'dtypes': {col: str(dt) for col, dt in dtypes.items()}}, f)
+        os.replace(tmp_path, binary_path)
+        os.replace('{}.json'.format(tmp_path), '{}.json'.format(binary_path))
+
+    def _log_memory(self, name, table):
+        default_bytes = 0
+        compact_bytes = 0
+        for col in table.columns:
+            values = table[col]
+            compact_bytes += values.memory_usage(index=False, deep=False)
+            default_bytes += 8 * len(values)
+            if values.dtype.name == 'category':
+                # an object column also holds a python string for every non-null row
+                codes = values.cat.codes.values
+                str_sizes = np.array([sys.getsizeof(cat) for cat in values.cat.categories], dtype=np.int64)
+                default_bytes += int(np.bincount(codes[codes >= 0], minlength=len(str_sizes)).dot(str_sizes))
+                compact_bytes += int(str_sizes.sum())
+
+        previous = self._memory.get(name, (0, 0))
+        self._memory[name] = (previous[0] + default_bytes, previous[1] + compact_bytes)
+        logging.debug('{}: {:.1f} MB with compact dtypes, {:.1f} MB saved'.format(
+            name, self._memory[name][1] / 2 ** 20, (self._memory[name][0] - self._memory[name][1]) / 2 ** 20))
+
+    @staticmethod
+    def _hash_file(path, chunk_size=1 << 23):
+        file_hash = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+
+def _categories_by_appearance(values):
+    # used categories in order of their first row, na values counting as 'Unspecified'
+    codes = values.cat.codes.values
+    used, first_rows = np.unique(codes, return_index=True)
+    labels = [values.cat.categories[code] if code >= 0 else 'Unspecified' for code in used]
+    return pd.Index(labels)[np.argsort(first_rows)]
+
+
+_stores = {}
+
+
+def get_table_store(data_dir='data'):
+    """
+    Return the table store shared by every loader in this process for the given data directory.
+    """
+    key = os.path.abspath(data_dir)
+    if key not in _stores:
+        _stores[key] = TableStore(data_dir)
+    return _stores[key]
@@ -0,0 +1,152 @@
+import os
+import json
+import logging
+import numpy as np
+from scipy.sparse import issparse
+
+
+class TensorStore:
+    """
+    Directory of .npy arrays with a small json manifest of shapes, dtypes and row id order. Arrays are
+    read back memory-mapped, so processes using the same store share one copy through the page cache.
+    """
+    manifest_file = 'manifest.json'
+
+    def __init__(self, store_dir):
+        self._store_dir = store_dir
+        self._manifest = {}
+
+        manifest_path = os.path.join(store_dir, self.manifest_file)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self._manifest = json.load(f)
+
+    def __contains__(self, name):
+        return name in self._manifest and os.path.exists(self._path(name))
+
+    def save(self, name, array, ids=None, chunk_rows=65536, dtype=np.float32):
+        """
+        Write a dense or sparse 2d array to the store and return it memory-mapped
+
+        :param name: name of the array in the store
+        :param array: numpy array or scipy sparse matrix, sparse rows are densified chunk by chunk
+        :param ids: optional id of each row, saved alongside the array
+        :param dtype: dtype of the stored array
+        """
+        os.makedirs(self._store_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp.npy'.format(self._path(name)[:-4], os.getpid())
+        stored = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=array.shape)
+        for start in range(0, array.shape[0], chunk_rows):
+            chunk = array[start:start + chunk_rows]
+            stored[start:start + chunk_rows] = chunk.toarray() if issparse(chunk) else chunk
+        stored.flush()
+        del stored
+        os.replace(tmp_path, self._path(name))
+
+        entry = {'file': os.path.basename(self._path(name)), 'shape': list(array.shape), 'dtype': np.dtype(dtype).name}
+        if ids is not None:
+            np.save(self._path(name + '_ids'), np.asarray(ids))
+            entry['ids'] = os.path.basename(self._path(name + '_ids'))
+        self._update_manifest(name, entry)
+        logging.debug('Saved {} with shape {} to {}'.format(name, array.shape, self._store_dir))
+
+        return self.load(name)
+
+    def load(self, name):
+        """
+        Memory-mapped read-only view of an array in the store
+        """
+        return np.load(self._path(name), mmap_mode='r')
+
+    def load_ids(self, name):
+        return np.load(os.path.join(self._store_dir, self._manifest[name]['ids']))
+
+    def _path(self, name):
+        return os.path.join(self._store_dir, '{}.npy'.format(name))
+
+    def _update_manifest(self, name, entry):
+        # re-read the manifest so entries written by other processes are kept
+        manifest_path = os.path.join(self._store_dir, self.manifest_file)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self._manifest = json.load(f)
+        self._manifest[name] = entry
+
+        tmp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self._manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+
+class RowView:
+    """
+    Lazy selection of rows from a (memory-mapped) array. Indexing with an array of row numbers returns
+    another view, rows are only read into memory by take or when converted with np.asarray.
+    """
+    def __init__(self, base, rows):
+        rows = np.asarray(rows)
+        if isinstance(base, RowView):
+            base, rows = base._base, base._rows[rows]
+        self._base = base
+        self._rows = rows
+
+    @property
+    def shape(self):
+        return (len(self._rows), *self._base.shape[1:])
+
+    @property
+    def dtype(self):
+        return self._base.dtype
+
+    @property
+    def ndim(self):
+        return self._base.ndim
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self._base[self._rows[item]]
+        return RowView(self._base, self._rows[item])
+
+    def take(self, rows):
+        """
+        Read the given rows of the view into memory
+        """
+        base_rows = self._rows[rows]
+        # reading rows in ascending order keeps access to the underlying file sequential
+        order = np.argsort(base_rows, kind='stable')
+        values = np.empty((len(base_rows), *self._base.shape[1:]), dtype=self._base.dtype)
+        values[order] = self._base[base_rows[order]]
+        return values
+
+    def __array__(self, dtype=None):
+        values = self.take(np.arange(len(self._rows)))
+        return values if dtype is None else values.astype(dtype)
+
+
+def take_rows(array, rows):
+    """
+    Select rows of an array, as a view where possible: contiguous rows are sliced and other selections
+    of memory-mapped arrays return a lazy RowView.
+    """
+    rows = np.asarray(rows)
+    if len(rows) > 0 and rows[-1] - rows[0] == len(rows) - 1 and np.all(np.diff(rows) == 1):
+        return array[rows[0]:rows[-1] + 1]
+    if isinstance(array, (np.memmap, RowView)):
+        return RowView(array, rows)
+    return array[rows]
+
+
+def read_rows(array, rows):
+    """
+    Read the given rows of a dense, sparse, memory-mapped or RowView array into a dense numpy array
+    """
+    if isinstance(array, RowView):
+        return array.take(rows)
+    if issparse(array):
+        return array[rows].toarray()
+    if isinstance(array, np.memmap):
+        return RowView(array, np.arange(array.shape[0])).take(rows)
+    return np.asarray(array[rows])
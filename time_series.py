@@ -0,0 +1,91 @@
+import numpy as np
+from scipy.sparse import issparse
+from tensor_store import read_rows
+
+
+def monthly_tensor(table, sk_ids, tmax, id_col='SK_ID_CURR', month_col='MONTHS_BALANCE', dummies=None):
+    """
+    Sum the rows of a monthly table into a dense (n_ids, tmax, n_features) float32 tensor.
+
+    Rows of the tensor are the unique sk_ids in ascending order and the time axis runs from month -tmax
+    to month -1. Every column of table other than id_col and month_col is a feature, na values count as
+    zero and rows for other ids or months outside the window are ignored.
+
+    :param table: DataFrame with id, month and numeric feature columns
+    :param sk_ids: ids to build the tensor for
+    :param tmax: number of months in the window
+    :param dummies: optional sparse one-hot matrix with the rows of table, its columns are features after
+    those of the table
+    :return: tuple of (sorted unique ids, tensor)
+    """
+    ids = np.unique(sk_ids)
+    feature_cols = [col for col in table.columns if col not in (id_col, month_col)]
+    n_dummies = dummies.shape[1] if dummies is not None else 0
+    tensor = np.zeros((len(ids), tmax, len(feature_cols) + n_dummies), dtype=np.float32)
+    if len(ids) == 0:
+        return ids, tensor
+
+    # map ids to row codes and months to time offsets
+    table_ids = table[id_col].values
+    rows = np.searchsorted(ids, table_ids)
+    rows[rows == len(ids)] = 0
+    offsets = table[month_col].values.astype(np.int64) + tmax
+    keep = (ids[rows] == table_ids) & (offsets >= 0) & (offsets < tmax)
+    flat_index = rows[keep] * tmax + offsets[keep]
+
+    # accumulate each feature into its slot of the tensor
+    for i, col in enumerate(feature_cols):
+        values = np.nan_to_num(table[col].values[keep].astype(np.float64))
+        tensor[:, :, i] = np.bincount(flat_index, weights=values, minlength=len(ids) * tmax).reshape(len(ids), tmax)
+
+    # the ones of the one-hot columns go straight to their slot, without densifying the rows
+    if n_dummies:
+        entries = dummies.tocoo()
+        slots = np.full(len(table), -1, dtype=np.int64)
+        slots[keep] = flat_index
+        entry_slots = slots[entries.row]
+        kept = entry_slots >= 0
+        tensor[:, :, len(feature_cols):] = np.bincount(entry_slots[kept] * n_dummies + entries.col[kept],
+                                                       weights=entries.data[kept].astype(np.float64),
+                                                       minlength=len(ids) * tmax * n_dummies
+                                                       ).reshape(len(ids), tmax, n_dummies)
+
+    return ids, tensor
+
+
+def flatten_feature_major(tensor):
+    """
+    Flatten a (n_ids, tmax, n_features) tensor to (n_ids, n_features * tmax) with all time steps of
+    the first feature first, the layout produced by unstacking a (id, month) indexed frame.
+    """
+    return tensor.transpose(0, 2, 1).reshape(tensor.shape[0], -1)
+
+
+def sequence_lengths(data, sequence_length, chunk_rows=65536):
+    """
+    Real length of each row's sequence: the number of time steps from the first step with any non-zero
+    feature to the end of the window, zero for rows without history.
+
+    :param data: flat feature-major (n_ids, n_features * sequence_length) array or sparse matrix, or a
+    (n_ids, sequence_length, n_features) array
+    :param sequence_length: number of time steps in the window
+    :return: int32 array of lengths
+    """
+    n_rows = data.shape[0]
+    first_step = np.full(n_rows, sequence_length, dtype=np.int64)
+
+    if issparse(data):
+        data = data.tocoo()
+        nonzero = data.data != 0
+        np.minimum.at(first_step, data.row[nonzero], data.col[nonzero] % sequence_length)
+        return (sequence_length - first_step).astype(np.int32)
+
+    for start in range(0, n_rows, chunk_rows):
+        rows = np.arange(start, min(start + chunk_rows, n_rows))
+        values = read_rows(data, rows)
+        if values.ndim == 2:
+            values = values.reshape(len(rows), -1, sequence_length).transpose(0, 2, 1)
+        has_data = np.any(values != 0, axis=2)
+        first_step[rows] = np.where(has_data.any(axis=1), has_data.argmax(axis=1), sequence_length)
+
+    return (sequence_length - first_step).astype(np.int32)